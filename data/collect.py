@@ -1,21 +1,50 @@
 #!/usr/bin/python
 
-from riot_api import RiotApiScheduler, ApiRequest, RiotApi, RiotItems, API_KEY
-from workers import PlayerWorker, MatchWorker
+from riot_api import RiotApiScheduler, ApiRequest, RiotApi, RiotItems, API_KEY, RateLimiter, ResponseCache
+from workers import PlayerWorker, MatchWorker, CollectionPipeline, CollectionCheckpoint
 from db import PlayerDb, MatchDb, BuildDb
-from util import datetime_to_timestamp, MatchProcessor
+from util import datetime_to_timestamp, MatchProcessor, MatchProcessorPool, Refresher, StatusServer, TriePruner
+from metrics import Metrics, MetricsReporter
+from consolidate import consolidate
+from finalize import finalize
 
+import os
+import functools
 import signal
+import subprocess
 import sys
 import argparse
 import time
 import datetime
+import threading
 from Queue import Queue
 
 from pymongo import MongoClient
 
 MAX_PLAYER_QSIZE = 500
 MAX_MATCH_QSIZE = 1500
+MAX_LANE_WEIGHT = 5
+STATUS_PORT = 8000
+
+def lane_weights(player_queue, match_queue):
+  # Give the API budget to whichever stage is the bottleneck: a backed up match queue
+  # means matchlist requests only add refs we can't process yet, and vice versa
+  match_fill = min(float(match_queue.qsize()) / MAX_MATCH_QSIZE, 1)
+  player_fill = min(float(player_queue.qsize()) / MAX_PLAYER_QSIZE, 1)
+  return {
+    ApiRequest.MATCH: 1 + (MAX_LANE_WEIGHT - 1) * match_fill,
+    ApiRequest.MATCHLIST: 1 + (MAX_LANE_WEIGHT - 1) * (1 - match_fill) * max(player_fill, .5),
+    ApiRequest.LEAGUE: 1,
+  }
+
+def consolidate_in_subprocess(mongo_url, processes, prune):
+  # Forking a pool from this process, whose other threads may hold locks the children inherit
+  # locked, can deadlock them, so parallel refreshes consolidate in a fresh process
+  command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "consolidate.py"),
+    "--incremental", "-n", str(processes), "--mongo", mongo_url]
+  if prune is not None:
+    command += ["--prune_tries", "--max_trie_depth", str(prune[0]), "--min_branch_count", str(prune[1])]
+  subprocess.check_call(command)
 
 def main(argv):
   mongo_url = "mongodb://localhost:27017"
@@ -32,6 +61,52 @@ def main(argv):
   parser.add_argument("--update_old", action='store_true', help="Whether to prioritize gathering of new player data")
   parser.add_argument("--mongo", default=mongo_url, help="URL of MongoDB")
   parser.add_argument("--api_key", default=API_KEY, help="Riot API Key")
+  parser.add_argument("--rate_limits", default=None,
+    help="Rate limits of the API key as requests:seconds pairs, i.e '10:10,500:600'")
+  parser.add_argument("--api_url", default=None, help="Base URL of the API, i.e a local fake_api.py")
+  parser.add_argument("--cache", default=None, help="Directory to cache raw match responses in")
+  parser.add_argument("--cache_size", default=10, type=float, help="Max size of the match cache in GB")
+  parser.add_argument("--api_threads", default=RiotApiScheduler.EXECUTOR_SIZE, type=int,
+    help="# of threads making API requests")
+  parser.add_argument("--build_buffer", default=500, type=int,
+    help="# of builds to merge in memory before writing them in bulk, 0 to write each one immediately")
+  parser.add_argument("--flush_interval", default=BuildDb.FLUSH_INTERVAL, type=float,
+    help="Max seconds between writes of buffered builds")
+  parser.add_argument("--match_filter", default=os.path.expanduser("~/.outliers/match_ids.bloom"),
+    help="File to persist the filter of known match ids in between runs, '' to always rebuild it")
+  parser.add_argument("--pipeline", action='store_true',
+    help="Run collection as a callback driven pipeline instead of player/match worker threads (-n is ignored)")
+  parser.add_argument("--in_flight", default=CollectionPipeline.MAX_IN_FLIGHT, type=int,
+    help="Max # of requests in flight with --pipeline")
+  parser.add_argument("--handler_threads", default=CollectionPipeline.HANDLER_THREADS, type=int,
+    help="# of threads processing responses with --pipeline")
+  parser.add_argument("--processes", default=0, type=int,
+    help="# of processes to parse and process matches in, 0 to process them on the match worker threads. " +
+      "Each match worker (or --handler_threads thread) keeps one busy at a time.")
+  parser.add_argument("--checkpoint", default=os.path.expanduser("~/.outliers/checkpoint.json"),
+    help="File to periodically save queues to and resume them from, '' to disable")
+  parser.add_argument("--checkpoint_interval", default=CollectionCheckpoint.INTERVAL, type=float,
+    help="Seconds between checkpoints")
+  parser.add_argument("--compact_keys", action='store_true',
+    help="Use hashed/packed keys for builds, runes, masteries and skillups (smaller indexes)")
+  parser.add_argument("--max_trie_depth", default=None, type=int,
+    help="Only add the first N item purchases of a build to its item trie")
+  parser.add_argument("--metrics_interval", default=MetricsReporter.INTERVAL, type=float,
+    help="Seconds between printing API, queue, processing and MongoDB metrics, 0 to disable")
+  parser.add_argument("--daemon", action='store_true',
+    help="Run until SIGINT/SIGTERM instead of reading 'q' from stdin, refreshing the builds the site serves on a schedule")
+  parser.add_argument("--refresh_interval", default=Refresher.INTERVAL, type=float,
+    help="Max seconds between consolidation + finalization runs with --daemon, 0 to only refresh by --refresh_matches")
+  parser.add_argument("--refresh_matches", default=Refresher.MATCH_THRESHOLD, type=int,
+    help="Refresh early once this many new matches were collected with --daemon, 0 to only refresh by --refresh_interval")
+  parser.add_argument("--refresh_processes", default=1, type=int,
+    help="# of processes to consolidate in with --daemon, more than 1 runs consolidate.py in a subprocess")
+  parser.add_argument("--prune_tries", action='store_true',
+    help="Prune the item tries of the builds each --daemon refresh consolidates (see consolidate.py --prune_tries)")
+  parser.add_argument("--min_branch_count", default=TriePruner.MIN_COUNT, type=int,
+    help="Fold item trie branches bought fewer times than this into 'other' with --prune_tries")
+  parser.add_argument("--status_port", default=STATUS_PORT, type=int,
+    help="Port to serve /status and /health on with --daemon, 0 to disable")
   args = parser.parse_args()
 
   if args.d is not None:
@@ -41,47 +116,143 @@ def main(argv):
     sys.exit(2)
   else:
     RiotApi.set_api_key(args.api_key)
+  if args.api_url is not None:
+    RiotApi.set_base_url(args.api_url)
+  if args.cache is not None:
+    RiotApi.set_cache(ResponseCache(args.cache, int(args.cache_size * 1024 ** 3)))
 
   # Initialize MongoDB
   mongo_client = MongoClient(args.mongo)
   outliers_db = mongo_client.outliers
 
   # Initialize components
-  api_scheduler = RiotApiScheduler()
+  rate_limits = RateLimiter.parse_header(args.rate_limits) if args.rate_limits else None
   player_db = PlayerDb(outliers_db.players)
-  match_db = MatchDb(outliers_db.matches)
-  build_db = BuildDb(outliers_db)
+  match_db = MatchDb(outliers_db.matches, args.match_filter or None)
+  build_db = BuildDb(outliers_db, args.build_buffer, args.flush_interval, compact_keys=args.compact_keys,
+    max_trie_depth=args.max_trie_depth)
   player_queue = Queue(maxsize=MAX_PLAYER_QSIZE)
   match_queue = Queue(maxsize=MAX_MATCH_QSIZE)
+  api_scheduler = RiotApiScheduler(
+    rate_limits=rate_limits,
+    executor_size=args.api_threads,
+    weight_fn=lambda: lane_weights(player_queue, match_queue)
+  )
+
+  Metrics.add_gauge("queue.players", player_queue.qsize)
+  Metrics.add_gauge("queue.matches", match_queue.qsize)
+  for request_class in [ApiRequest.MATCH, ApiRequest.MATCHLIST, ApiRequest.LEAGUE]:
+    Metrics.add_gauge("queue.api." + request_class, functools.partial(api_scheduler.qsize, request_class))
+  Metrics.add_gauge("build_db.buffer", build_db.get_buffer_size)
+  reporter = MetricsReporter(args.metrics_interval) if args.metrics_interval > 0 else None
 
   riot_items = RiotItems()
   match_processor = MatchProcessor(riot_items)
+  match_pool = MatchProcessorPool(riot_items.patch, args.processes) if args.processes > 0 else None
 
   workers = []
 
+  checkpoint = None
+  if args.checkpoint:
+    checkpoint = CollectionCheckpoint(args.checkpoint,
+      player_db=player_db,
+      match_db=match_db,
+      player_queue=player_queue,
+      match_queue=match_queue,
+      last_update=last_update,
+      interval=args.checkpoint_interval
+    )
+    checkpoint.restore()
+
   # Initial seed
-  player_queue.put({
-      "profileIcon": 588,
-      "matchHistoryUri": "/v1/stats/player_history/NA/60783",
-      "summonerName": "-INITIAL_SEED- (TheOddOne)",
-      "summonerId": args.i,
-      "last_update": datetime_to_timestamp(PlayerDb.EARLIEST_UPDATE),
-      "league": "GOLD"
-   })
+  if not player_queue.full():
+    player_queue.put({
+        "profileIcon": 588,
+        "matchHistoryUri": "/v1/stats/player_history/NA/60783",
+        "summonerName": "-INITIAL_SEED- (TheOddOne)",
+        "summonerId": args.i,
+        "last_update": datetime_to_timestamp(PlayerDb.EARLIEST_UPDATE),
+        "league": "GOLD"
+     })
+
+  refresher = None
+  status_server = None
+  if args.daemon:
+    prune = None
+    if args.prune_tries:
+      prune = (args.max_trie_depth or TriePruner.MAX_DEPTH, args.min_branch_count)
+    def refresh():
+      build_db.flush()
+      if args.refresh_processes > 1:
+        consolidate_in_subprocess(args.mongo, args.refresh_processes, prune)
+      else:
+        consolidate(outliers_db, incremental=True, prune=prune)
+      # Swap the new builds in at once, so the site never reads a partial collection
+      finalize(outliers_db, output_name="unique_builds_next")
+      outliers_db.unique_builds_next.rename("unique_builds", dropTarget=True)
+    refresher = Refresher(refresh, match_db.get_num_marked,
+      interval=args.refresh_interval,
+      match_threshold=args.refresh_matches
+    )
+    if args.status_port:
+      status_server = StatusServer(args.status_port, lambda: get_status())
+
+  start_time = time.time()
+  def get_status():
+    elapsed = max(time.time() - start_time, 1e-6)
+    num_matches = match_db.get_num_marked()
+    num_players = player_db.get_num_updated()
+    return {
+      "healthy": api_scheduler.is_alive() and all(worker.is_alive() for worker in workers),
+      "uptime": elapsed,
+      "matches": num_matches,
+      "matches_per_sec": num_matches / elapsed,
+      "players": num_players,
+      "players_per_sec": num_players / elapsed,
+      "player_queue": player_queue.qsize(),
+      "match_queue": match_queue.qsize(),
+      "scheduler_queue": api_scheduler.qsize(),
+      "rate_limits": api_scheduler.get_rate_limits(),
+      "build_buffer": build_db.get_buffer_size(),
+      "refresh": refresher.get_status() if refresher is not None else None,
+      "metrics": Metrics.snapshot(),
+    }
 
   # Register stop signal handler
   def stop(sig, frame):
+    if status_server is not None:
+      status_server.stop()
     api_scheduler.stop()
     for worker in workers:
       worker.stop()
+    if match_pool is not None:
+      match_pool.shutdown()
+    if checkpoint is not None:
+      checkpoint.stop()
+    if refresher is not None:
+      refresher.stop()
+    build_db.stop()
+    match_db.save_filter()
+    if reporter is not None:
+      reporter.stop()
     print "[STOP] Players left: %r, Matches left: %r" % (player_queue.qsize(), match_queue.qsize())
-  signal.signal(signal.SIGINT, stop)
+
+  stop_event = threading.Event()
+  if args.daemon:
+    # Only flag the stop, the main thread does it once it's out of the handler
+    signal.signal(signal.SIGINT, lambda sig, frame: stop_event.set())
+    signal.signal(signal.SIGTERM, lambda sig, frame: stop_event.set())
+  else:
+    signal.signal(signal.SIGINT, stop)
 
   # Start threads
   api_scheduler.start()
+  build_db.start()
+  if reporter is not None:
+    reporter.start()
 
-  for i in xrange(args.n[0]):
-    worker = PlayerWorker(
+  def make_player_worker():
+    return PlayerWorker(
       is_prioritize_new=not args.update_old,
       api_scheduler=api_scheduler,
       player_db=player_db,
@@ -90,11 +261,9 @@ def main(argv):
       player_queue=player_queue,
       match_queue=match_queue,
     )
-    workers.append(worker)
-    worker.start()
 
-  for i in xrange(args.n[1]):
-    worker = MatchWorker(
+  def make_match_worker():
+    return MatchWorker(
       last_update=last_update,
       api_scheduler=api_scheduler,
       player_db=player_db,
@@ -102,10 +271,45 @@ def main(argv):
       build_db=build_db,
       player_queue=player_queue,
       match_queue=match_queue,
-      match_processor=match_processor
+      match_processor=match_processor,
+      match_pool=match_pool
+    )
+
+  if args.pipeline:
+    pipeline = CollectionPipeline(
+      api_scheduler=api_scheduler,
+      stages=[make_match_worker(), make_player_worker()],
+      max_in_flight=args.in_flight,
+      handler_threads=args.handler_threads
     )
-    workers.append(worker)
-    worker.start()
+    workers.append(pipeline)
+    pipeline.start()
+  else:
+    for i in xrange(args.n[0]):
+      worker = make_player_worker()
+      workers.append(worker)
+      worker.start()
+
+    for i in xrange(args.n[1]):
+      worker = make_match_worker()
+      workers.append(worker)
+      worker.start()
+
+  if checkpoint is not None:
+    for worker in workers:
+      for worker_id in worker.get_ids():
+        checkpoint.add_owner(worker_id)
+    checkpoint.start()
+
+  if args.daemon:
+    refresher.start()
+    if status_server is not None:
+      status_server.start()
+      print "[DAEMON] Serving status on port %d" % args.status_port
+    while not stop_event.is_set():
+      stop_event.wait(1)  # with a timeout so signals are handled
+    stop(signal.SIGTERM, None)
+    return
 
   # Janky way to quit program
   line = raw_input()
@@ -1,7 +1,13 @@
 import sys, argparse, threading
+import multiprocessing
+import signal
 from pymongo import MongoClient
 from bson import ObjectId
 from bson import SON
+from bson.codec_options import CodecOptions
+
+from util import BuildConsolidator, TriePruner
+from db import BuildGroupDb
 
 
 def build_id_for_substr(start, length):
@@ -371,23 +377,10 @@ function(id, builds) {
 """
 
 
-def main(argv):
-  mongo_url = "mongodb://localhost:27017"
-  
-  parser = argparse.ArgumentParser(description='Aggregate player builds by champion, build, and role')
-  parser.add_argument("-i", default="builds", help="Collection to aggregate from")
-  parser.add_argument("-o", default="builds_consolidated", help="Output collection")
-  parser.add_argument("--temp", default="temp", help="Temp data collection")
-  parser.add_argument("--mongo", default=mongo_url, help="URL of MongoDB")
-  args = parser.parse_args()
-
-  # Initialize MongoDB
-  mongo_client = MongoClient(args.mongo)
-  outliers_db = mongo_client.outliers
-
-  input_coll = outliers_db[args.i]
-  temp_coll = outliers_db[args.temp]
-  output_coll = outliers_db[args.o]
+def consolidate_map_reduce(outliers_db, input_name="builds", output_name="builds_consolidated", temp_name="temp"):
+  input_coll = outliers_db[input_name]
+  temp_coll = outliers_db[temp_name]
+  output_coll = outliers_db[output_name]
 
   # Build pipeline
   def pipeline(build_size, is_first_stage=False):
@@ -404,7 +397,7 @@ def main(argv):
       # Filter out builds of other sizes and regroup by id
       {"$match": {"finalBuild": {"$size": 6}}},
       {"$group": {"_id": "$_original_id", "value": {"$first": "$$CURRENT"}}},
-      { "$out" :  args.o if is_first_stage else args.temp}
+      { "$out" :  output_name if is_first_stage else temp_name}
     ]
 
   # Reset output
@@ -419,11 +412,11 @@ def main(argv):
     input_coll.aggregate(pipeline(i, i==5), allowDiskUse=True)
     if i != 5:
       print "Merging with output collection through map-reduce..."
-      temp_coll.map_reduce(PARTIAL_MAP_FN, PARTIAL_REDUCE_FN, out=SON([('reduce', args.o)]),
+      temp_coll.map_reduce(PARTIAL_MAP_FN, PARTIAL_REDUCE_FN, out=SON([('reduce', output_name)]),
         sort={"_id": 1})
 
   print "Finalizing results via map-reduce..."
-  output_coll.map_reduce(FINALIZE_MAP_FN, FINALIZE_REDUCE_FN, out=SON([('replace', args.o)]),
+  output_coll.map_reduce(FINALIZE_MAP_FN, FINALIZE_REDUCE_FN, out=SON([('replace', output_name)]),
       sort={"_id": 1})
 
   output_coll.delete_many({"value.itemEvents": None})
@@ -432,5 +425,161 @@ def main(argv):
   print "...dropping temp collections."
   temp_coll.drop()
 
+# Per process consolidator for --processes, set up by init_worker since MongoClient can't be
+# shared across a fork
+_consolidator = None
+
+def _read_as_son(collection):
+  # Ties between equally common runes etc. go to the first one, like in the map-reduce
+  return collection.with_options(codec_options=CodecOptions(document_class=SON))
+
+def _make_consolidator(input_coll, output_coll, prune):
+  pruner = TriePruner(input_coll, *prune) if prune is not None else None
+  return BuildConsolidator(input_coll, output_coll, pruner=pruner)
+
+def init_worker(mongo_url, input_name, output_name, prune):
+  global _consolidator
+  signal.signal(signal.SIGINT, signal.SIG_IGN)  # main process terminates the pool
+  outliers_db = MongoClient(mongo_url).outliers
+  _consolidator = _make_consolidator(_read_as_son(outliers_db[input_name]), outliers_db[output_name], prune)
+
+def consolidate_shard(champion_ids):
+  return _consolidator.run({"championId": {"$in": champion_ids}})
+
+def consolidate_groups(groups):
+  return _consolidator.run_groups(groups)
+
+def make_shards(items, num_shards):
+  # Round robin, so popular (low id) champions are spread out
+  return [shard for shard in (items[i::num_shards] for i in xrange(num_shards)) if shard]
+
+def _run_parallel(fn, tasks, processes, init_args):
+  pool = multiprocessing.Pool(processes, init_worker, init_args)
+  try:
+    results = list(pool.imap_unordered(fn, tasks))
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+  return results
+
+def consolidate(outliers_db, input_name="builds", output_name="builds_consolidated", temp_name="temp",
+    map_reduce=False, incremental=False, processes=1, mongo_url=None, shards_per_process=4, prune=None):
+  # processes > 1 consolidates shards of champions in parallel, each process connecting to mongo_url.
+  # prune is (max_depth, min_count) to prune the item tries of the builds read (see TriePruner).
+  # Groups written to after this stay dirty for the next incremental run
+  group_db = BuildGroupDb(outliers_db.build_groups)
+  dirty = group_db.find_dirty()
+
+  input_coll = _read_as_son(outliers_db[input_name])
+  output_coll = outliers_db[output_name]
+  if incremental and not map_reduce and output_coll.find_one() is None:
+    print "No previous output, consolidating all builds"
+    incremental = False
+
+  if map_reduce:
+    consolidate_map_reduce(outliers_db, input_name, output_name, temp_name)
+  elif incremental:
+    print "Consolidating %d changed champion/lane/role groups..." % len(dirty)
+    groups = sorted(dirty)
+    if processes > 1:
+      by_champion = {}
+      for group in groups:
+        by_champion.setdefault(group[0], []).append(group)
+      shards = make_shards(sorted(by_champion), processes * shards_per_process)
+      tasks = [[group for champion_id in shard for group in by_champion[champion_id]] for shard in shards]
+      num_builds = sum(_run_parallel(consolidate_groups, tasks, processes, (mongo_url, input_name, output_name, prune)))
+    else:
+      num_builds = _make_consolidator(input_coll, output_coll, prune).run_groups(groups)
+    print "Done! %d builds" % num_builds
+  else:
+    # Built next to the output and swapped in at once, the output stays as is if this fails
+    staging_name = output_name + "_next"
+    staging_coll = outliers_db[staging_name]
+    staging_coll.drop()
+    staging_coll.create_index("value.championId")
+
+    print "Consolidating builds..."
+    if processes > 1:
+      champion_ids = sorted(input_coll.distinct("championId"))
+      shards = make_shards(champion_ids, processes * shards_per_process)
+      print "...in %d shards of %d champions over %d processes" % (len(shards), len(champion_ids), processes)
+      results = _run_parallel(consolidate_shard, shards, processes, (mongo_url, input_name, staging_name, prune))
+      num_groups, num_builds = [sum(r) for r in zip(*results)] or [0, 0]
+    else:
+      num_groups, num_builds = _make_consolidator(input_coll, staging_coll, prune).run()
+    staging_coll.rename(output_name, dropTarget=True)
+    print "Done! %d builds of %d champion/lane/role groups" % (num_builds, num_groups)
+
+  group_db.mark_clean(dirty)
+
+def _values_equal(a, b):
+  # Consolidated values, numbers only need to match up to float error
+  if isinstance(a, dict) and isinstance(b, dict):
+    keys = set(k for k in a if a[k] is not None) | set(k for k in b if b[k] is not None)
+    return all(_values_equal(a.get(k), b.get(k)) for k in keys)
+  if isinstance(a, list) and isinstance(b, list):
+    return len(a) == len(b) and all(_values_equal(x, y) for x, y in zip(a, b))
+  if isinstance(a, (int, long, float)) and isinstance(b, (int, long, float)):
+    return abs(a - b) <= 1e-9 * max(abs(a), abs(b), 1)
+  return a == b
+
+def compare(outliers_db, output_name, expected_name):
+  # Reports differences between two consolidated collections, i.e this and a --map_reduce run
+  output_coll = outliers_db[output_name]
+  expected = dict((doc["_id"], doc["value"]) for doc in outliers_db[expected_name].find())
+  missing = len(expected)
+  extra = 0
+  different = 0
+  for doc in output_coll.find():
+    value = expected.get(doc["_id"])
+    if value is None:
+      extra += 1
+      continue
+    missing -= 1
+    if not _values_equal(doc["value"], value):
+      different += 1
+      if different <= 5:
+        print "!! Build %s differs:\n  %r\n  %r" % (doc["_id"], doc["value"], value)
+  print "Compared %s to %s: %d missing, %d extra, %d different" % (
+    output_name, expected_name, missing, extra, different)
+  return missing == extra == different == 0
+
+def main(argv):
+  mongo_url = "mongodb://localhost:27017"
+  
+  parser = argparse.ArgumentParser(description='Aggregate player builds by champion, build, and role')
+  parser.add_argument("-i", default="builds", help="Collection to aggregate from")
+  parser.add_argument("-o", default="builds_consolidated", help="Output collection")
+  parser.add_argument("--temp", default="temp", help="Temp data collection (--map_reduce only)")
+  parser.add_argument("--map_reduce", action='store_true',
+    help="Consolidate with MongoDB aggregations and map-reduces instead of a single pass in Python")
+  parser.add_argument("--incremental", action='store_true',
+    help="Only reconsolidate champion/lane/role groups with builds written since the last run (not with --map_reduce)")
+  parser.add_argument("-n", "--processes", default=1, type=int,
+    help="# of processes to consolidate shards of champions in (not with --map_reduce)")
+  parser.add_argument("--prune_tries", action='store_true',
+    help="Prune the item tries of the builds consolidated, writing the pruned tries back to the input (not with --map_reduce)")
+  parser.add_argument("--max_trie_depth", default=TriePruner.MAX_DEPTH, type=int,
+    help="Max depth of item tries with --prune_tries")
+  parser.add_argument("--min_branch_count", default=TriePruner.MIN_COUNT, type=int,
+    help="Fold item trie branches bought fewer times than this into 'other' with --prune_tries")
+  parser.add_argument("--compare", default=None,
+    help="Collection of a previous consolidation (i.e with --map_reduce) to check the output against")
+  parser.add_argument("--mongo", default=mongo_url, help="URL of MongoDB")
+  args = parser.parse_args()
+
+  # Initialize MongoDB
+  mongo_client = MongoClient(args.mongo)
+  outliers_db = mongo_client.outliers
+
+  prune = (args.max_trie_depth, args.min_branch_count) if args.prune_tries else None
+  consolidate(outliers_db, args.i, args.o, args.temp, args.map_reduce, args.incremental,
+    processes=args.processes, mongo_url=args.mongo, prune=prune)
+  if args.compare is not None and not compare(outliers_db, args.o, args.compare):
+    sys.exit(1)
+
 if __name__ == "__main__":
    main(sys.argv[1:])
\ No newline at end of file
@@ -1,3 +1,4 @@
 from .player_db import PlayerDb
 from .match_db import MatchDb
-from .build_db import BuildDb
\ No newline at end of file
+from .build_db import BuildDb
+from .build_group_db import BuildGroupDb
\ No newline at end of file
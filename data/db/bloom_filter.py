@@ -0,0 +1,69 @@
+import hashlib
+import json
+import math
+import os
+import struct
+import threading
+
+class BloomFilter(object):
+  # Set of keys with no false negatives and about error_rate false positives while it holds at
+  # most capacity keys. Adding is thread safe, lookups don't lock.
+
+  def __init__(self, capacity, error_rate=.001):
+    self.capacity = capacity
+    self.error_rate = error_rate
+    self.count = 0
+    self._num_bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    self._num_hashes = max(1, int(round(float(self._num_bits) / capacity * math.log(2))))
+    self._bits = bytearray((self._num_bits + 7) // 8)
+    self._lock = threading.Lock()
+
+  def _indexes(self, key):
+    # Double hashing, k indexes from the two halves of one md5
+    h1, h2 = struct.unpack(">QQ", hashlib.md5(str(key)).digest())
+    return [(h1 + i * h2) % self._num_bits for i in xrange(self._num_hashes)]
+
+  def add(self, key):
+    indexes = self._indexes(key)
+    with self._lock:
+      for i in indexes:
+        self._bits[i >> 3] |= 1 << (i & 7)
+      self.count += 1
+
+  def __contains__(self, key):
+    bits = self._bits
+    for i in self._indexes(key):
+      if not bits[i >> 3] & (1 << (i & 7)):
+        return False
+    return True
+
+  def save(self, path, **meta):
+    # JSON header line followed by the raw bits, extra meta is returned by load
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+      os.makedirs(directory)
+    header = dict(meta, capacity=self.capacity, error_rate=self.error_rate, count=self.count)
+    tmp_path = path + ".tmp"
+    with self._lock:
+      with open(tmp_path, "wb") as f:
+        f.write(json.dumps(header) + "\n")
+        f.write(self._bits)
+    os.rename(tmp_path, path)
+
+  @staticmethod
+  def load(path):
+    # Returns (filter, meta) or (None, None) if there is no usable file
+    if not os.path.exists(path):
+      return None, None
+    try:
+      with open(path, "rb") as f:
+        header = json.loads(f.readline())
+        bloom = BloomFilter(header["capacity"], header["error_rate"])
+        bits = f.read()
+    except (IOError, ValueError, KeyError):
+      return None, None
+    if len(bits) != len(bloom._bits):
+      return None, None
+    bloom._bits = bytearray(bits)
+    bloom.count = header["count"]
+    return bloom, header
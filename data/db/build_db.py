@@ -1,53 +1,154 @@
 from pymongo.collection import ReturnDocument
-from pymongo import ASCENDING
+from pymongo.errors import BulkWriteError, OperationFailure, PyMongoError
+from pymongo import ASCENDING, UpdateOne
+
+import hashlib
+import struct
+import threading
+import time
+
+from metrics import Metrics
+from .id_cache import IdCache
+from .build_group_db import BuildGroupDb
 
 class BuildDb(object):
+  # Write-behind: with buffer_size > 0, insert_builds only merges the participants into an
+  # in-memory buffer, which is written with a single bulk write once it holds buffer_size builds
+  # or flush_interval seconds passed. start() runs a thread for the time threshold, stop() flushes.
+  #
+  # Compact keys: with compact_keys, rune and mastery pages are keyed by a 64 bit hash and skill
+  # orders by the slots packed into an int instead of long strings. Builds get an extra hashed
+  # _hkey field which replaces _key in the compound index (_key is still stored since consolidation
+  # groups builds by its prefixes). Pick one format per database, i.e reprocess.py --drop.
+  #
+  # Every write marks the champion/lane/role groups it touched in build_groups (BuildGroupDb), so
+  # consolidate.py --incremental only has to redo those.
+  #
+  # max_trie_depth only adds the first max_trie_depth item events of a build to its item trie, so
+  # long purchase orders don't keep making documents deeper (see also TriePruner).
+  FLUSH_INTERVAL = 5  # seconds
+  # Builds indexes from before the index led with the group fields, replaced by the current one
+  _OLD_INDEXES = ["_key_1_championId_1_lane_1_role_1", "_hkey_1_championId_1_lane_1_role_1"]
+  ID_CACHE_SIZE = 20000  # per collection
 
-  def __init__(self, db):
+  def __init__(self, db, buffer_size=0, flush_interval=FLUSH_INTERVAL, id_cache_size=ID_CACHE_SIZE,
+      compact_keys=False, max_trie_depth=None):
     self._db = db
+    self._compact_keys = compact_keys
+    self._max_trie_depth = max_trie_depth
+    # Ids of runes, masteries and skillups already in the db, so only new ones need a round-trip
+    self._id_caches = {
+      "runes": IdCache(id_cache_size),
+      "masteries": IdCache(id_cache_size),
+      "skillups": IdCache(id_cache_size),
+    }
+    self._buffer_size = buffer_size
+    self._flush_interval = flush_interval
+    self._buffer_lock = threading.Lock()
+    self._buffer = {}  # guarded by buffer_lock
+    self._unmarked = set()  # groups of written builds whose mark failed, guarded by buffer_lock
+    self._last_flush = time.time()
+    self._is_running = False
+    self._flush_event = threading.Event()
+    self._thread = threading.Thread(target=self._run, name="BUILD_FLUSHER")
+    self._groups = BuildGroupDb(db.build_groups)  # for incremental consolidation
+
+    # Led by the group fields, so consolidation can read builds one champion/lane/role at a time
     self._db.builds.create_index([
-      ("_key", ASCENDING),
       ("championId", ASCENDING),
       ("lane", ASCENDING),
-      ("role", ASCENDING)
+      ("role", ASCENDING),
+      ("_hkey" if compact_keys else "_key", ASCENDING)
     ])
+    self._drop_old_indexes()
     self._db.runes.create_index("_key")
     self._db.masteries.create_index("_key")
     self._db.skillups.create_index("_key")
     return
 
-  def insert_runes(self, runes):
-    _key = "".join([str((r["runeId"], r["rank"])) for r in runes])
-    result = self._db.runes.find_one_and_update(
+  def _drop_old_indexes(self):
+    for name in BuildDb._OLD_INDEXES:
+      if name not in self._db.builds.index_information():
+        continue
+      try:
+        self._db.builds.drop_index(name)
+        print "[BUILD_DB] Dropped old builds index %s" % name
+      except OperationFailure:
+        pass  # another process dropped it first
+
+  @staticmethod
+  def _hash_key(key):
+    # Signed since MongoDB only has signed 64 bit ints
+    return struct.unpack(">q", hashlib.sha1(key).digest()[:8])[0]
+
+  @staticmethod
+  def _pack_skillups(skillups):
+    # Slots 1-4 as base 5 digits, 18 of them fit in 42 bits. None if there are other slots.
+    packed = 0
+    for slot in skillups:
+      if slot not in ("1", "2", "3", "4"):
+        return None
+      packed = packed * 5 + int(slot)
+    return packed
+
+  @Metrics.timed("mongo.build_db.upsert_value")
+  def _upsert_value(self, collection, _key, value):
+    return self._db[collection].find_one_and_update(
       {"_key": _key},
-      {"$setOnInsert": {"_key": _key, "value": runes}},
+      {"$setOnInsert": {"_key": _key, "value": value}},
       upsert=True,
       return_document=ReturnDocument.AFTER
     )
-    return str(result["_id"])
+
+  def _find_or_insert(self, collection, cache_key, make_key, value, content_fn, compact_key=None):
+    # cache_key is a cheap tuple of the content, make_key builds the stored string _key on a miss.
+    # content_fn maps a stored value back to its cache key, to detect compact key collisions.
+    cache = self._id_caches[collection]
+    _id = cache.get(cache_key)
+    if _id is not None:
+      return _id
+
+    result = None
+    if self._compact_keys:
+      if compact_key is None:
+        compact_key = BuildDb._hash_key(make_key())
+      result = self._upsert_value(collection, compact_key, value)
+      if content_fn(result["value"]) != cache_key:
+        print "!! [BUILD_DB] %s key collision on %r, using full key" % (collection, compact_key)
+        result = None
+    if result is None:
+      result = self._upsert_value(collection, make_key(), value)
+
+    _id = str(result["_id"])
+    cache.put(cache_key, _id)
+    return _id
+
+  def insert_runes(self, runes):
+    cache_key = tuple((r["runeId"], r["rank"]) for r in runes)
+    return self._find_or_insert("runes", cache_key,
+      lambda: "".join([str(r) for r in cache_key]), runes,
+      lambda value: tuple((r["runeId"], r["rank"]) for r in value))
 
   def insert_masteries(self, masteries):
-    _key = "".join([str((m["masteryId"], m["rank"])) for m in masteries])
-    result = self._db.masteries.find_one_and_update(
-      {"_key": _key},
-      {"$setOnInsert": {"_key": _key, "value": masteries}},
-      upsert=True,
-      return_document=ReturnDocument.AFTER
-    )
-    return str(result["_id"])
+    cache_key = tuple((m["masteryId"], m["rank"]) for m in masteries)
+    return self._find_or_insert("masteries", cache_key,
+      lambda: "".join([str(m) for m in cache_key]), masteries,
+      lambda value: tuple((m["masteryId"], m["rank"]) for m in value))
 
   def insert_skillups(self, skillups):
     if len(skillups) < 18:
       return None
 
-    _key = "".join(skillups)
-    result = self._db.skillups.find_one_and_update(
-      {"_key": _key},
-      {"$setOnInsert": {"_key": _key, "value": skillups}},
-      upsert=True,
-      return_document=ReturnDocument.AFTER
-    )
-    return str(result["_id"])
+    cache_key = tuple(skillups)
+    return self._find_or_insert("skillups", cache_key, lambda: "".join(skillups), skillups,
+      tuple, BuildDb._pack_skillups(skillups) if self._compact_keys else None)
+
+  def get_buffer_size(self):
+    # Builds waiting to be written
+    return len(self._buffer)
+
+  def get_id_cache_stats(self):
+    return dict((collection, cache.get_stats()) for collection, cache in self._id_caches.iteritems())
 
   def _get_item_trie_paths(self, itemEvents):
     path = "itemEvents"
@@ -63,7 +164,8 @@ class BuildDb(object):
       item_paths.append(path_obj)
     return item_paths
 
-  def insert_build(self, participant):
+  def _get_build_update(self, participant):
+    # Returns the (query, update) for adding a participant to its build document
     build = participant["build"]
     stats = participant["stats"]
     _key = ",".join(build["finalBuild"])
@@ -102,7 +204,7 @@ class BuildDb(object):
       update_param["$inc"][skillups_key] = 1
 
     # Generate update param for item trie
-    item_paths = self._get_item_trie_paths(build["itemEvents"])
+    item_paths = self._get_item_trie_paths(build["itemEvents"][:self._max_trie_depth])
     for path_obj in item_paths:
       if path_obj["is_final_item"]:
         update_param["$setOnInsert"][path_obj["path"] + ".is_final_item"] = True
@@ -111,16 +213,124 @@ class BuildDb(object):
       update_param["$inc"][path_obj["path"] + ".wins"] = 1 if stats["winner"] else 0
       update_param["$inc"][path_obj["path"] + ".timestamp"] = path_obj["timestamp"]
 
-    # Make update
-    result = self._db.builds.find_one_and_update(
-      {
-        "championId": build["championId"],
-        "lane": build["lane"],
-        "role": build["role"],
-        "_key": _key
-      },
-      update_param,
-      upsert=True,
-      return_document=ReturnDocument.AFTER
-    )
-    return str(result["_id"])
+    query = {
+      "championId": build["championId"],
+      "lane": build["lane"],
+      "role": build["role"],
+      "_key": _key
+    }
+    if self._compact_keys:
+      # _key stays in the query, so a hash collision just means an extra document fetched
+      query["_hkey"] = BuildDb._hash_key(_key)
+    return query, update_param
+
+  def _merge_build_updates(self, update, intou):
+    for field, value in update["$inc"].iteritems():
+      intou["$inc"][field] = intou["$inc"].get(field, 0) + value
+    for field, value in update["$setOnInsert"].iteritems():
+      intou["$setOnInsert"].setdefault(field, value)
+
+  def _buffer_update(self, buf, query, update_param):
+    key = (query["championId"], query["lane"], query["role"], query["_key"])
+    if key in buf:
+      self._merge_build_updates(update_param, buf[key][1])
+    else:
+      buf[key] = (query, update_param)
+
+  @Metrics.timed("mongo.build_db.bulk_write")
+  def _write_updates(self, updates):
+    # Returns the updates that failed, so they can be retried
+    if not updates:
+      return []
+    try:
+      self._db.builds.bulk_write(
+        [UpdateOne(query, update_param, upsert=True) for query, update_param in updates],
+        ordered=False
+      )
+    except BulkWriteError as e:
+      failed = [updates[error["index"]] for error in e.details["writeErrors"]]
+      print "!! [BUILD_DB] %d of %d build writes failed" % (len(failed), len(updates))
+      return failed
+    except PyMongoError as e:
+      print "!! [BUILD_DB] %d build writes failed (%r)" % (len(updates), e)
+      return updates
+    return []
+
+  def _mark_written(self, updates, failed):
+    # Marks the groups of the updates that were written, along with the ones that failed to be
+    # marked before
+    groups = set(BuildGroupDb.get_group(query) for query, _ in updates)
+    groups.difference_update(BuildGroupDb.get_group(query) for query, _ in failed)
+    with self._buffer_lock:
+      groups.update(self._unmarked)
+      self._unmarked = set()
+    try:
+      self._groups.mark(groups)
+    except PyMongoError as e:
+      print "!! [BUILD_DB] Failed to mark %d build groups (%r)" % (len(groups), e)
+      with self._buffer_lock:
+        self._unmarked.update(groups)
+
+  def insert_builds(self, participants):
+    # Increments of participants with the same build are summed up first, then buffered or
+    # written with a single bulk write, and the groups they touched are marked once. Returns # of
+    # builds updated.
+    buf = {}
+    for participant in participants:
+      query, update_param = self._get_build_update(participant)
+      self._buffer_update(buf, query, update_param)
+
+    if self._buffer_size > 0:
+      with self._buffer_lock:
+        for query, update_param in buf.itervalues():
+          self._buffer_update(self._buffer, query, update_param)
+        is_full = len(self._buffer) >= self._buffer_size
+      if is_full or time.time() - self._last_flush >= self._flush_interval:
+        self.flush()
+      return len(buf)
+
+    failed = self._write_updates(buf.values())
+    self._mark_written(buf.values(), failed)
+    return len(buf) - len(failed)
+
+  def flush(self):
+    # Writes out the buffered builds, failed writes are merged back into the buffer (adding their
+    # counts to whatever was buffered in the meantime) to be retried by the next flush
+    with self._buffer_lock:
+      buf = self._buffer
+      self._buffer = {}
+      self._last_flush = time.time()
+    failed = self._write_updates(buf.values())
+    self._mark_written(buf.values(), failed)
+    if failed:
+      with self._buffer_lock:
+        for query, update_param in failed:
+          self._buffer_update(self._buffer, query, update_param)
+    return len(buf) - len(failed)
+
+  def _run(self):
+    while self._is_running:
+      self._flush_event.wait(self._flush_interval)
+      try:
+        self.flush()
+      except Exception as e:
+        print "!! [BUILD_DB] Exception while flushing builds: %r" % e
+
+  def start(self):
+    if self._buffer_size > 0:
+      self._is_running = True
+      self._thread.start()
+
+  def stop(self):
+    # Call after the workers stopped, writes out whatever is left in the buffer
+    if self._is_running:
+      self._is_running = False
+      self._flush_event.set()
+      self._thread.join()
+    written = self.flush()
+    if written:
+      print "[BUILD_DB] Flushed %d buffered builds" % written
+    if self._buffer:
+      print "!! [BUILD_DB] Dropped %d buffered builds that failed to be written" % len(self._buffer)
+    for collection, stats in sorted(self.get_id_cache_stats().iteritems()):
+      print "[BUILD_DB] %s id cache: %d hits, %d misses" % (collection, stats["hits"], stats["misses"])
@@ -0,0 +1,54 @@
+from pymongo.errors import BulkWriteError
+from pymongo import ASCENDING, UpdateOne
+
+from metrics import Metrics
+
+class BuildGroupDb(object):
+  # Champion/lane/role groups whose builds changed since they were last consolidated. Every write
+  # to a group's builds bumps its version and sets dirty, consolidation clears dirty only if the
+  # version is still the one it read before reading the builds, so no write is missed.
+  GROUP_FIELDS = ["championId", "lane", "role"]
+  _DUPLICATE_KEY = 11000
+
+  def __init__(self, group_collection):
+    self._groups = group_collection
+    self._groups.create_index([(field, ASCENDING) for field in BuildGroupDb.GROUP_FIELDS], unique=True)
+    self._groups.create_index("dirty")
+
+  @staticmethod
+  def get_group(build):
+    return tuple(build[field] for field in BuildGroupDb.GROUP_FIELDS)
+
+  @staticmethod
+  def get_query(group):
+    return dict(zip(BuildGroupDb.GROUP_FIELDS, group))
+
+  @Metrics.timed("mongo.build_group_db.mark")
+  def mark(self, groups):
+    # Call after the builds were written
+    if not groups:
+      return
+    try:
+      self._groups.bulk_write([UpdateOne(
+        BuildGroupDb.get_query(group),
+        {"$inc": {"version": 1}, "$set": {"dirty": True}},
+        upsert=True
+      ) for group in groups], ordered=False)
+    except BulkWriteError as e:
+      # Upserts racing with another process's, which marked the group already
+      failed = [error for error in e.details["writeErrors"] if error["code"] != BuildGroupDb._DUPLICATE_KEY]
+      if failed:
+        print "!! [BUILD_GROUP_DB] Failed to mark %d groups" % len(failed)
+
+  def find_dirty(self):
+    # Returns {group: version}
+    return dict((BuildGroupDb.get_group(doc), doc["version"]) for doc in self._groups.find({"dirty": True}))
+
+  def mark_clean(self, versions):
+    # Groups whose version changed since are left dirty
+    if not versions:
+      return
+    self._groups.bulk_write([UpdateOne(
+      dict(BuildGroupDb.get_query(group), version=version),
+      {"$set": {"dirty": False}}
+    ) for group, version in versions.iteritems()], ordered=False)
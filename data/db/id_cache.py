@@ -0,0 +1,37 @@
+import threading
+from collections import OrderedDict
+
+class IdCache(object):
+  # Bounded LRU from a content key to the id of its document, safe to share between threads
+
+  def __init__(self, max_size):
+    self._max_size = max_size
+    self._lock = threading.Lock()
+    self._entries = OrderedDict()  # least recently used first, guarded by lock
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key):
+    with self._lock:
+      value = self._entries.pop(key, None)
+      if value is None:
+        self.misses += 1
+        return None
+      self._entries[key] = value
+      self.hits += 1
+      return value
+
+  def put(self, key, value):
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = value
+      if len(self._entries) > self._max_size:
+        self._entries.popitem(last=False)
+
+  def get_stats(self):
+    with self._lock:
+      return {
+        "entries": len(self._entries),
+        "hits": self.hits,
+        "misses": self.misses,
+      }
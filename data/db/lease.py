@@ -0,0 +1,44 @@
+import time
+
+# Batch claiming of work items: documents matching a query are leased to one owner (worker) until
+# the lease expires, so items of a crashed or stopped worker become claimable again on their own.
+LEASE_OWNER = "lease_owner"
+LEASE_EXPIRES = "lease_expires"
+
+def now_ms():
+  return int(time.time() * 1000)
+
+def unleased(query, now):
+  # Query for documents matching query that nobody holds a lease on
+  return {"$and": [query, {"$or": [
+    {LEASE_EXPIRES: None},
+    {LEASE_EXPIRES: {"$lt": now}}
+  ]}]}
+
+def claim(collection, query, owner, limit, lease_ms):
+  # Returns up to limit documents (as they were before claiming) now leased to owner
+  now = now_ms()
+  free = unleased(query, now)
+  ids = [doc["_id"] for doc in collection.find(free, {"_id": 1}).limit(limit)]
+  if not ids:
+    return []
+
+  # Others may claim some of the same ids at the same time, only the ones we got are returned
+  expires = now + lease_ms
+  collection.update_many(
+    {"$and": [free, {"_id": {"$in": ids}}]},
+    {"$set": {LEASE_OWNER: owner, LEASE_EXPIRES: expires}}
+  )
+  claimed = list(collection.find({"_id": {"$in": ids}, LEASE_OWNER: owner, LEASE_EXPIRES: expires}))
+  for doc in claimed:
+    del doc[LEASE_OWNER], doc[LEASE_EXPIRES]
+  return claimed
+
+def release_update():
+  return {"$unset": {LEASE_OWNER: "", LEASE_EXPIRES: ""}}
+
+def release_owners(collection, owners):
+  # Releases every lease held by the given owners, returns how many there were
+  if not owners:
+    return 0
+  return collection.update_many({LEASE_OWNER: {"$in": owners}}, release_update()).modified_count
@@ -1,15 +1,108 @@
+import threading
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+from pymongo import ASCENDING
+
+from metrics import Metrics
+from .bloom_filter import BloomFilter
+from . import lease
 
 class MatchDb(object):
+  # Known match ids are kept in a Bloom filter, so refs of new matches don't need a lookup and
+  # the ones of matches we may already have (most of them, since ten players share each match)
+  # are checked in one query per matchlist. It is built from the collection at startup, or
+  # loaded from filter_path if that is still in sync with it.
+  LEASE_TIME = 30 * 60 * 1000  # ms, for claimed refs
+  FILTER_MIN_CAPACITY = 1000000
+  FILTER_ERROR_RATE = .001
+  _DUPLICATE_KEY = 11000
 
-  def __init__(self, match_collection):
+  def __init__(self, match_collection, filter_path=None):
     self._matches = match_collection
-    self._matches.create_index("matchId")
+    self._filter_path = filter_path
+    self._create_unique_index()
+    self._matches.create_index([("is_ref", ASCENDING), (lease.LEASE_EXPIRES, ASCENDING)])
+    self._known_ids = self._load_filter()
+    self._lock = threading.Lock()
+    self._num_marked = 0  # matches marked by this process, guarded by lock
     return
 
+  def _create_unique_index(self):
+    # Covers races between threads inserting the same ref. Databases from before this had a
+    # non-unique index, which needs to be replaced.
+    try:
+      self._matches.create_index("matchId", unique=True)
+    except DuplicateKeyError:
+      print "!! [MATCH_DB] Duplicate matchIds in collection, matchId index is not unique"
+      self._matches.create_index("matchId")
+    except OperationFailure:
+      self._matches.drop_index("matchId_1")
+      self._create_unique_index()
+
+  def _load_filter(self):
+    num_matches = self._matches.count()
+    if self._filter_path is not None:
+      bloom, meta = BloomFilter.load(self._filter_path)
+      if bloom is not None and meta.get("num_matches") == num_matches and num_matches <= bloom.capacity:
+        print "[MATCH_DB] Loaded filter of %d match ids" % num_matches
+        return bloom
+
+    capacity = max(2 * num_matches, MatchDb.FILTER_MIN_CAPACITY)
+    bloom = BloomFilter(capacity, MatchDb.FILTER_ERROR_RATE)
+    for match in self._matches.find({}, {"matchId": 1, "_id": 0}):
+      bloom.add(match["matchId"])
+    print "[MATCH_DB] Built filter of %d match ids" % num_matches
+    return bloom
+
+  def save_filter(self):
+    if self._filter_path is not None:
+      self._known_ids.save(self._filter_path, num_matches=self._matches.count())
+
   def insert_ref(self, match_ref):
     match_ref.update({"is_ref": True})
     self._matches.insert(match_ref)
+    self._known_ids.add(match_ref["matchId"])
+
+  @Metrics.timed("mongo.match_db.insert_refs")
+  def insert_refs(self, match_refs):
+    # Inserts the refs of matches that aren't known yet and returns those. Refs the filter says
+    # are new need no lookup, the ones it thinks we have are checked with a single query, since a
+    # false positive would otherwise be skipped every time the match comes up again.
+    positives = set(ref["matchId"] for ref in match_refs if ref["matchId"] in self._known_ids)
+    if positives:
+      found = self._matches.find({"matchId": {"$in": list(positives)}}, {"matchId": 1, "_id": 0})
+      positives.difference_update(match["matchId"] for match in found)
+
+    new_refs = []
+    new_ids = set()
+    for match_ref in match_refs:
+      match_id = match_ref["matchId"]
+      if (match_id not in self._known_ids or match_id in positives) and match_id not in new_ids:
+        match_ref.update({"is_ref": True})
+        new_refs.append(match_ref)
+        new_ids.add(match_id)
+    if not new_refs:
+      return []
 
+    failed = set()
+    unknown = set()
+    try:
+      self._matches.insert_many(new_refs, ordered=False)
+    except BulkWriteError as e:
+      # Duplicates were inserted by another thread (or missing from a stale filter) in the meantime
+      for error in e.details["writeErrors"]:
+        failed.add(error["index"])
+        if error["code"] != MatchDb._DUPLICATE_KEY:
+          unknown.add(error["index"])
+      if unknown:
+        print "!! [MATCH_DB] Failed to insert %d match refs" % len(unknown)
+
+    for i, match_ref in enumerate(new_refs):
+      if i not in unknown:
+        self._known_ids.add(match_ref["matchId"])
+    return [match_ref for i, match_ref in enumerate(new_refs) if i not in failed]
+
+  @Metrics.timed("mongo.match_db.mark")
   def mark(self, match):
     match.update({"is_ref": False})
     self._matches.replace_one(
@@ -17,18 +110,36 @@ class MatchDb(object):
       match,
       upsert=True
     )
+    self._known_ids.add(match["matchId"])
+    with self._lock:
+      self._num_marked += 1
 
+  def get_num_marked(self):
+    return self._num_marked
+
+  @Metrics.timed("mongo.match_db.contains")
   def contains(self, match_ref):
+    if match_ref["matchId"] not in self._known_ids:
+      return False
     return bool(self._matches.find_one({"matchId": match_ref["matchId"]}))
 
-  def find_needs_update(self):
-    return self._matches.find_one_and_update(
-      {"is_ref": True},
-      {"$set": {"is_ref": False}}
-    )
+  @Metrics.timed("mongo.match_db.claim_refs")
+  def claim_refs(self, owner, limit):
+    # Refs stay is_ref until mark, a ref whose worker died is claimable again after LEASE_TIME
+    return lease.claim(self._matches, {"is_ref": True}, owner, limit, MatchDb.LEASE_TIME)
 
+  def release_leases(self, owners):
+    return lease.release_owners(self._matches, owners)
+
+  def find_pending_refs(self, match_ids):
+    # Refs of the given matches that still need to be fetched, in the given order
+    if not match_ids:
+      return []
+    refs = dict((ref["matchId"], ref) for ref in self._matches.find({"matchId": {"$in": match_ids}, "is_ref": True}))
+    return [refs[match_id] for match_id in match_ids if match_id in refs]
+
+  @Metrics.timed("mongo.match_db.return_match")
   def return_match(self, match_ref):
-    self._matches.update(
-      {"matchId": match_ref["matchId"]},
-      {"$set": {"is_ref": True}}
-    )
+    update = lease.release_update()
+    update["$set"] = {"is_ref": True}
+    self._matches.update({"matchId": match_ref["matchId"]}, update)
@@ -1,27 +1,54 @@
 from pymongo.collection import ReturnDocument
+from pymongo import ASCENDING
 import datetime
+import threading
 
 from util import datetime_to_timestamp
+from metrics import Metrics
+from . import lease
 
 class PlayerDb(object):
   EARLIEST_UPDATE = datetime.datetime(2015, 8, 20)
+  LEASE_TIME = 10 * 60 * 1000  # ms, for claimed players
 
   def __init__(self, player_collection):
     self._players = player_collection
+    self._players.create_index("summonerId")
+    self._players.create_index([("last_update", ASCENDING), (lease.LEASE_EXPIRES, ASCENDING)])
+    self._lock = threading.Lock()
+    self._num_updated = 0  # players updated by this process, guarded by lock
     return
 
+  @Metrics.timed("mongo.player_db.update_matches")
   def update_matches(self, player, timestamp):
-    self._players.update_one(
-      {"summonerId": player["summonerId"]},
-      {"$set": {"last_update": timestamp}}
-    )
+    update = lease.release_update()
+    update["$set"] = {"last_update": timestamp}
+    self._players.update_one({"summonerId": player["summonerId"]}, update)
+    with self._lock:
+      self._num_updated += 1
 
-  def find_stale(self, last_update):
-    return self._players.find_one_and_update(
-      {"last_update": {"$lt": last_update}},
-      {"$set": {"last_update": last_update}}
-    )
+  def get_num_updated(self):
+    return self._num_updated
+
+  @Metrics.timed("mongo.player_db.claim_stale")
+  def claim_stale(self, last_update, owner, limit):
+    # Players keep their last_update until update_matches or return_player
+    return lease.claim(self._players, {"last_update": {"$lt": last_update}}, owner, limit, PlayerDb.LEASE_TIME)
 
+  def release_leases(self, owners):
+    return lease.release_owners(self._players, owners)
+
+  def find_stale_players(self, summoner_ids, last_update):
+    # Players of the given ids that still need an update, in the given order
+    if not summoner_ids:
+      return []
+    players = dict((p["summonerId"], p) for p in self._players.find({
+      "summonerId": {"$in": summoner_ids},
+      "last_update": {"$lt": last_update}
+    }))
+    return [players[summoner_id] for summoner_id in summoner_ids if summoner_id in players]
+
+  @Metrics.timed("mongo.player_db.find_or_create")
   def find_or_create(self, player):
 
     player = self._players.find_one_and_update(
@@ -36,10 +63,10 @@ class PlayerDb(object):
 
     return player
 
+  @Metrics.timed("mongo.player_db.return_player")
   def return_player(self, player):
-    self._players.update(
-      {"summonerId": player["summonerId"]},
-      {"$set": {"last_update": player["last_update"]}}
-    )
+    update = lease.release_update()
+    update["$set"] = {"last_update": player["last_update"]}
+    self._players.update({"summonerId": player["summonerId"]}, update)
 
 
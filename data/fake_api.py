@@ -0,0 +1,392 @@
+#!/usr/bin/python
+
+# Local stand-in for the Riot API, for load testing collect.py without burning a real key.
+# Serves recorded fixtures (see --export) or synthetic data, with configurable rate limits and latency.
+
+from riot_api import RiotApi, RateLimiter, API_KEY
+from riot_api.items import RiotItems
+
+import sys, argparse, threading, time, random, re, os, json, gzip, StringIO
+import BaseHTTPServer, SocketServer, urlparse
+
+
+class SyntheticData(object):
+  # Deterministic fake matches/matchlists, seeded by id so repeated requests agree with each other
+  _TIERS = ["CHALLENGER", "MASTER", "DIAMOND", "PLATINUM", "GOLD", "SILVER", "BRONZE"]
+  _LANES = [("TOP", "SOLO"), ("JUNGLE", "NONE"), ("MIDDLE", "SOLO"), ("BOTTOM", "DUO_CARRY"), ("BOTTOM", "DUO_SUPPORT")]
+  _COMPONENTS = range(1001, 1031)
+  _FINALS = range(3801, 3861)
+  _POTION = 2003
+  _FIRST_MATCH_ID = 1900000000
+  _FIRST_SUMMONER_ID = 20000000
+  _MATCH_DURATION = 30 * 60 * 1000  # ms
+
+  def __init__(self, num_matches, num_summoners, matches_per_player):
+    self._num_matches = num_matches
+    self._num_summoners = num_summoners
+    self._matches_per_player = matches_per_player
+
+  def get_items(self):
+    items = {}
+    def add(iid, **kwargs):
+      item = {"id": iid, "name": "Item %d" % iid}
+      item.update(kwargs)
+      items[str(iid)] = item
+
+    # Items RiotItems expects to exist
+    for iid in RiotItems._FINAL_ITEM_BLACKLIST:
+      add(iid)
+    for iid in RiotItems._FINAL_ITEM_WHITELIST:
+      add(iid, into=[])
+
+    finals_by_component = {}
+    for i, iid in enumerate(SyntheticData._FINALS):
+      components = [SyntheticData._COMPONENTS[(2 * i + j) % len(SyntheticData._COMPONENTS)] for j in xrange(2)]
+      for component in components:
+        finals_by_component.setdefault(component, []).append(str(iid))
+      add(iid, **{"from": [str(c) for c in components]})
+    for iid in SyntheticData._COMPONENTS:
+      add(iid, into=finals_by_component.get(iid, []))
+
+    return {"type": "item", "version": "5.16.1", "data": items}
+
+  def _match_ids(self, rng, count):
+    return [SyntheticData._FIRST_MATCH_ID + rng.randrange(self._num_matches) for _ in xrange(count)]
+
+  def get_matchlist(self, summoner_id, begin_time):
+    rng = random.Random(summoner_id)
+    now = int(time.time() * 1000)
+    matches = []
+    for match_id in sorted(set(self._match_ids(rng, self._matches_per_player)), reverse=True):
+      lane, role = rng.choice(SyntheticData._LANES)
+      timestamp = now - (match_id - SyntheticData._FIRST_MATCH_ID) * 1000
+      if begin_time and timestamp < begin_time:
+        continue
+      matches.append({
+        "matchId": match_id,
+        "platformId": "NA1",
+        "region": "NA",
+        "queue": "RANKED_SOLO_5x5",
+        "season": "SEASON2015",
+        "champion": rng.randrange(1, 130),
+        "lane": lane,
+        "role": role,
+        "timestamp": timestamp,
+      })
+    return {"matches": matches, "totalGames": len(matches), "startIndex": 0, "endIndex": len(matches)}
+
+  def _item_events(self, rng, pid):
+    # Potions, then 6 final items each built from its components. Occasionally undo a purchase.
+    events = [(rng.randrange(1000, 5000), "ITEM_PURCHASED", SyntheticData._POTION)]
+    timestamp = 90000
+    for _ in xrange(6):
+      final = rng.choice(SyntheticData._FINALS)
+      i = SyntheticData._FINALS.index(final)
+      for j in xrange(2):
+        component = SyntheticData._COMPONENTS[(2 * i + j) % len(SyntheticData._COMPONENTS)]
+        timestamp += rng.randrange(30000, 120000)
+        events.append((timestamp, "ITEM_PURCHASED", component))
+        if rng.random() < .05:
+          timestamp += 1000
+          events.append((timestamp, "ITEM_UNDO", component))
+          timestamp += 1000
+          events.append((timestamp, "ITEM_PURCHASED", component))
+      timestamp += rng.randrange(30000, 120000)
+      events.append((timestamp, "ITEM_PURCHASED", final))
+
+    ret = []
+    for timestamp, event_type, iid in events:
+      event = {"eventType": event_type, "participantId": pid, "timestamp": timestamp}
+      if event_type == "ITEM_UNDO":
+        event.update({"itemBefore": iid, "itemAfter": 0})
+      else:
+        event["itemId"] = iid
+      ret.append(event)
+    return ret
+
+  def _skill_events(self, rng, pid):
+    events = []
+    for level in xrange(18):
+      events.append({
+        "eventType": "SKILL_LEVEL_UP",
+        "levelUpType": "NORMAL",
+        "participantId": pid,
+        "skillSlot": 4 if level in (5, 10, 15) else rng.choice([1, 2, 3]),
+        "timestamp": 60000 + level * 90000 + rng.randrange(1000),
+      })
+    return events
+
+  def get_match(self, match_id):
+    rng = random.Random(match_id)
+    winning_team = rng.choice([100, 200])
+    participants = []
+    identities = []
+    events = []
+    for pid in xrange(1, 11):
+      team_id = 100 if pid <= 5 else 200
+      lane, role = SyntheticData._LANES[(pid - 1) % 5]
+      summoner_id = SyntheticData._FIRST_SUMMONER_ID + rng.randrange(self._num_summoners)
+      identities.append({
+        "participantId": pid,
+        "player": {
+          "summonerId": summoner_id,
+          "summonerName": "Fake%d" % summoner_id,
+          "profileIcon": 588,
+          "matchHistoryUri": "/v1/stats/player_history/NA/%d" % summoner_id,
+        }
+      })
+      participants.append({
+        "participantId": pid,
+        "teamId": team_id,
+        "championId": rng.randrange(1, 130),
+        "spell1Id": 4,
+        "spell2Id": rng.choice([3, 7, 11, 12, 14]),
+        "highestAchievedSeasonTier": rng.choice(SyntheticData._TIERS),
+        "runes": [{"runeId": 5245 + r, "rank": 9} for r in rng.sample(range(20), 3)],
+        "masteries": [{"masteryId": 6111 + m, "rank": 1} for m in rng.sample(range(30), 6)],
+        "timeline": {"lane": lane, "role": role},
+        "stats": {
+          "winner": team_id == winning_team,
+          "kills": rng.randrange(15),
+          "deaths": rng.randrange(15),
+          "assists": rng.randrange(20),
+          "totalDamageDealtToChampions": rng.randrange(5000, 40000),
+          "minionsKilled": rng.randrange(20, 300),
+          "goldEarned": rng.randrange(8000, 20000),
+        }
+      })
+      events.extend(self._item_events(rng, pid))
+      events.extend(self._skill_events(rng, pid))
+
+    events.sort(key=lambda e: e["timestamp"])
+    frames = []
+    for start in xrange(0, SyntheticData._MATCH_DURATION, 60000):
+      frame_events = [e for e in events if start <= e["timestamp"] < start + 60000]
+      frame = {"timestamp": start}
+      if frame_events:
+        frame["events"] = frame_events
+      frames.append(frame)
+
+    return {
+      "matchId": match_id,
+      "region": "NA",
+      "platformId": "NA1",
+      "matchMode": "CLASSIC",
+      "matchType": "MATCHED_GAME",
+      "matchCreation": int(time.time() * 1000),
+      "matchDuration": SyntheticData._MATCH_DURATION / 1000,
+      "matchVersion": "5.16.0.294",
+      "mapId": 11,
+      "season": "SEASON2015",
+      "queueType": "RANKED_SOLO_5x5",
+      "teams": [{"teamId": 100, "winner": winning_team == 100}, {"teamId": 200, "winner": winning_team == 200}],
+      "participants": participants,
+      "participantIdentities": identities,
+      "timeline": {"frameInterval": 60000, "frames": frames},
+    }
+
+  def get_league(self, summoner_id):
+    rng = random.Random(summoner_id)
+    return [{"tier": rng.choice(SyntheticData._TIERS), "queue": "RANKED_SOLO_5x5", "name": "Fake League"}]
+
+
+class FixtureData(SyntheticData):
+  # Serves recorded matches from <dir>/matches/<matchId>.json.gz and items from <dir>/items.json.
+  # Matchlists are made up from the recorded match ids, so every ref can be fetched.
+
+  def __init__(self, fixture_dir, matches_per_player):
+    self._dir = fixture_dir
+    match_dir = os.path.join(fixture_dir, "matches")
+    self._recorded_ids = sorted([int(f.split(".")[0]) for f in os.listdir(match_dir) if f.endswith(".json.gz")])
+    super(FixtureData, self).__init__(len(self._recorded_ids), 0, matches_per_player)
+
+  def get_items(self):
+    path = os.path.join(self._dir, "items.json")
+    if not os.path.exists(path):
+      return super(FixtureData, self).get_items()
+    with open(path) as f:
+      return json.load(f)
+
+  def _match_ids(self, rng, count):
+    return [rng.choice(self._recorded_ids) for _ in xrange(count)]
+
+  def get_match(self, match_id):
+    path = os.path.join(self._dir, "matches", "%d.json.gz" % match_id)
+    if not os.path.exists(path):
+      return None
+    with gzip.open(path) as f:
+      return json.load(f)
+
+
+class FakeRiotApiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"  # keep-alive
+
+  _ROUTES = [
+    (re.compile(r"^/api/lol/static-data/\w+/v[\d.]+/item$"), "_get_items"),
+    (re.compile(r"^/api/lol/static-data/\w+/v[\d.]+/versions$"), "_get_versions"),
+    (re.compile(r"^/api/lol/\w+/v[\d.]+/match/(\d+)$"), "_get_match"),
+    (re.compile(r"^/api/lol/\w+/v[\d.]+/matchlist/by-summoner/(\d+)$"), "_get_matchlist"),
+    (re.compile(r"^/api/lol/\w+/v[\d.]+/league/by-summoner/([\d,]+)$"), "_get_league"),
+  ]
+
+  def log_message(self, format, *args):
+    if self.server.verbose:
+      BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+  def _send(self, status, data=None, headers=None):
+    body = json.dumps(data) if data is not None else ""
+    if body and "gzip" in (self.headers.getheader("Accept-Encoding") or ""):
+      buf = StringIO.StringIO()
+      with gzip.GzipFile(fileobj=buf, mode="wb") as f:
+        f.write(body)
+      body = buf.getvalue()
+      headers = dict(headers or {}, **{"Content-Encoding": "gzip"})
+
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json;charset=utf-8")
+    self.send_header("Content-Length", str(len(body)))
+    for key, value in (headers or {}).iteritems():
+      self.send_header(key, value)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    server = self.server
+    url = urlparse.urlsplit(self.path)
+    query = dict(urlparse.parse_qsl(url.query))
+
+    is_allowed = server.rate_limiter.acquire()
+    headers = {
+      "X-Rate-Limit": ",".join(["%d:%d" % l for l in server.rate_limiter.get_limits()]),
+      "X-Rate-Limit-Count": ",".join(["%d:%d" % c for c in server.rate_limiter.get_counts()]),
+    }
+    if not is_allowed:
+      server.record(429)
+      headers["Retry-After"] = str(max(int(server.rate_limiter.delay() + .999), 1))
+      headers["X-Rate-Limit-Type"] = "user"
+      return self._send(429, headers=headers)
+
+    if server.latency:
+      time.sleep(max(random.gauss(server.latency, server.latency / 4), 0))
+
+    for pattern, handler in FakeRiotApiHandler._ROUTES:
+      match = pattern.match(url.path)
+      if match:
+        data = getattr(self, handler)(query, *match.groups())
+        break
+    else:
+      data = None
+
+    status = 200 if data is not None else 404
+    server.record(status)
+    self._send(status, data, headers)
+
+  def _get_items(self, query):
+    items = self.server.data.get_items()
+    if query.get("version", items["version"]) != items["version"]:
+      return None
+    return items
+
+  def _get_versions(self, query):
+    return [self.server.data.get_items()["version"]]
+
+  def _get_match(self, query, match_id):
+    return self.server.data.get_match(int(match_id))
+
+  def _get_matchlist(self, query, summoner_id):
+    return self.server.data.get_matchlist(int(summoner_id), int(query.get("beginTime", 0)))
+
+  def _get_league(self, query, summoner_ids):
+    return {sid: self.server.data.get_league(int(sid)) for sid in summoner_ids.split(",")}
+
+
+class FakeRiotApiServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  request_queue_size = 128  # default of 5 drops connections when a burst opens many at once
+
+  def __init__(self, address, data, rate_limits, latency=0, verbose=False):
+    BaseHTTPServer.HTTPServer.__init__(self, address, FakeRiotApiHandler)
+    self.data = data
+    self.rate_limiter = RateLimiter(rate_limits, margin=0)
+    self.latency = latency
+    self.verbose = verbose
+
+    self._lock = threading.Lock()
+    self._counts = {}  # status -> count, guarded by lock
+
+  def record(self, status):
+    with self._lock:
+      self._counts[status] = self._counts.get(status, 0) + 1
+
+  def get_counts(self):
+    with self._lock:
+      return dict(self._counts)
+
+
+def export_fixtures(mongo_url, fixture_dir, count, api_key):
+  # Dumps stored matches (MatchDb.mark keeps the full match) and current items as fixtures
+  from pymongo import MongoClient
+  matches = MongoClient(mongo_url).outliers.matches
+  match_dir = os.path.join(fixture_dir, "matches")
+  if not os.path.exists(match_dir):
+    os.makedirs(match_dir)
+
+  exported = 0
+  for match in matches.find({"is_ref": False, "timeline": {"$exists": True}}, {"_id": 0, "is_ref": 0}).limit(count):
+    with gzip.open(os.path.join(match_dir, "%d.json.gz" % match["matchId"]), "wb") as f:
+      json.dump(match, f)
+    exported += 1
+  print "Exported %d matches to %s" % (exported, match_dir)
+
+  if api_key:
+    RiotApi.set_api_key(api_key)
+    with open(os.path.join(fixture_dir, "items.json"), "w") as f:
+      json.dump(RiotApi.get_all_items(), f)
+    print "Exported items to %s" % fixture_dir
+
+
+def main(argv):
+  mongo_url = "mongodb://localhost:27017"
+
+  parser = argparse.ArgumentParser(description='Local fake Riot API for load testing')
+  parser.add_argument("-p", default=8080, type=int, help="Port to listen on")
+  parser.add_argument("-f", default=None, help="Fixture directory, serves synthetic data if not given")
+  parser.add_argument("--rate_limits", default="10:10,500:600", help="Rate limits to enforce, i.e '10:10,500:600'")
+  parser.add_argument("--latency", default=0, type=float, help="Mean response latency in seconds")
+  parser.add_argument("--matches", default=100000, type=int, help="# of distinct synthetic matches")
+  parser.add_argument("--summoners", default=50000, type=int, help="# of distinct synthetic summoners")
+  parser.add_argument("--matches_per_player", default=15, type=int, help="# of matches in each matchlist")
+  parser.add_argument("--export", default=None, type=int, help="Export this many stored matches to -f and exit")
+  parser.add_argument("--mongo", default=mongo_url, help="URL of MongoDB, for --export")
+  parser.add_argument("--api_key", default=API_KEY, help="Riot API Key, for exporting items with --export")
+  parser.add_argument("-v", action='store_true', help="Log every request")
+  args = parser.parse_args()
+
+  if args.export is not None:
+    if args.f is None:
+      print "Fixture directory (-f) required for --export"
+      sys.exit(2)
+    export_fixtures(args.mongo, args.f, args.export, args.api_key)
+    return
+
+  if args.f is not None:
+    data = FixtureData(args.f, args.matches_per_player)
+  else:
+    data = SyntheticData(args.matches, args.summoners, args.matches_per_player)
+
+  server = FakeRiotApiServer(("", args.p), data, RateLimiter.parse_header(args.rate_limits),
+    latency=args.latency, verbose=args.v)
+  print "Fake Riot API listening on port %d, use collect.py --api_url http://localhost:%d" % (args.p, args.p)
+
+  thread = threading.Thread(target=server.serve_forever, name="FAKE_API")
+  thread.daemon = True
+  thread.start()
+  try:
+    while True:
+      time.sleep(10)
+      print "[FAKE_API] Responses: %r" % server.get_counts()
+  except KeyboardInterrupt:
+    server.shutdown()
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
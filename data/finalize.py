@@ -2,6 +2,10 @@ import sys, argparse, threading
 from pymongo import MongoClient
 from bson import ObjectId
 from bson import SON
+from bson.codec_options import CodecOptions
+
+from util import BuildFinalizer
+from consolidate import compare
 
 ORDER_DELTA_MAP_FN = """
 function() {
@@ -140,12 +144,48 @@ function (id, builds) {
 """
 
 
+def finalize_map_reduce(outliers_db, input_name="builds_consolidated", output_name="unique_builds"):
+  input_coll = outliers_db[input_name]
+  output_coll = outliers_db[output_name]
+
+  output_coll.drop()
+  output_coll.create_index("value.championId")
+
+  print "Grouping for order deltas..."
+  input_coll.map_reduce(ORDER_DELTA_MAP_FN, DELTA_REDUCE_FN, out=SON([('replace', output_name)]), sort={"value.championId": 1})
+  for i in xrange(0, 6):
+    print "Grouping for item deltas with index %d" % i
+    output_coll.map_reduce(ITEM_DELTA_MAP_FN, DELTA_REDUCE_FN, out=SON([('replace', output_name)], sort={"value.championId": 1}),
+      scope={"_index": i}
+    )
+
+  print "Grouping by champion and determining outliers..."
+  output_coll.map_reduce(GROUP_MAP_FN, GROUP_REDUCE_FN, out=SON([('replace', output_name)]))
+
+def finalize(outliers_db, input_name="builds_consolidated", output_name="unique_builds", map_reduce=False):
+  if map_reduce:
+    finalize_map_reduce(outliers_db, input_name, output_name)
+    return
+
+  # Read as SON, so the builds' fields stay in the order the map-reduce output them in
+  input_coll = outliers_db[input_name].with_options(codec_options=CodecOptions(document_class=SON))
+  output_coll = outliers_db[output_name]
+  output_coll.drop()
+
+  print "Finalizing builds..."
+  num_champions, num_builds = BuildFinalizer(input_coll, output_coll).run()
+  print "Done! %d builds of %d champions" % (num_builds, num_champions)
+
 def main(argv):
   mongo_url = "mongodb://localhost:27017"
   
   parser = argparse.ArgumentParser(description='Determine unique builds')
   parser.add_argument("-i", default="builds_consolidated", help="Collection to analyze from")
   parser.add_argument("-o", default="unique_builds", help="Output collection")
+  parser.add_argument("--map_reduce", action='store_true',
+    help="Finalize with MongoDB map-reduces instead of a single pass in Python")
+  parser.add_argument("--compare", default=None,
+    help="Collection of a previous finalization (i.e with --map_reduce) to check the output against")
   parser.add_argument("--mongo", default=mongo_url, help="URL of MongoDB")
   args = parser.parse_args()
 
@@ -153,22 +193,9 @@ def main(argv):
   mongo_client = MongoClient(args.mongo)
   outliers_db = mongo_client.outliers
 
-  input_coll = outliers_db[args.i]
-  output_coll = outliers_db[args.o]
-
-  output_coll.drop()
-  output_coll.create_index("value.championId")
-
-  print "Grouping for order deltas..."
-  input_coll.map_reduce(ORDER_DELTA_MAP_FN, DELTA_REDUCE_FN, out=SON([('replace', args.o)]), sort={"value.championId": 1})
-  for i in xrange(0, 6):
-    print "Grouping for item deltas with index %d" % i
-    output_coll.map_reduce(ITEM_DELTA_MAP_FN, DELTA_REDUCE_FN, out=SON([('replace', args.o)], sort={"value.championId": 1}),
-      scope={"_index": i}
-    )
-
-  print "Grouping by champion and determining outliers..."
-  output_coll.map_reduce(GROUP_MAP_FN, GROUP_REDUCE_FN, out=SON([('replace', args.o)]))
+  finalize(outliers_db, args.i, args.o, args.map_reduce)
+  if args.compare is not None and not compare(outliers_db, args.o, args.compare):
+    sys.exit(1)
 
 
 if __name__ == "__main__":
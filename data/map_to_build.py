@@ -1,5 +1,5 @@
 from util import MatchProcessor
-from riot_api import RiotItems, RiotApi
+from riot_api import RiotItems, RiotApi, ResponseCache
 
 import sys, argparse, threading
 from pymongo import MongoClient
@@ -15,8 +15,13 @@ def main(argv):
   parser.add_argument("-t", default="any", help="Test single input. 'any' for random match (default)")
   parser.add_argument("-c", default=collection, help="Collection to process")
   parser.add_argument("--mongo", default=mongo_url, help="URL of MongoDB")
+  parser.add_argument("--cache", default=None, help="Directory of cached raw match responses")
+  parser.add_argument("--offline", action='store_true', help="Only read matches from --cache, never the API")
   args = parser.parse_args()
 
+  if args.cache is not None:
+    RiotApi.set_cache(ResponseCache(args.cache, read_only=args.offline))
+
   # Initialize MongoDB
   mongo_client = MongoClient(args.mongo)
   outliers_db = mongo_client.outliers
@@ -0,0 +1,2 @@
+from .metrics import Metrics, Counter, Histogram
+from .reporter import MetricsReporter
\ No newline at end of file
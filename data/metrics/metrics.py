@@ -0,0 +1,163 @@
+import bisect
+import functools
+import threading
+import time
+from collections import deque
+
+class Counter(object):
+  # Running total, plus a rate over the last RATE_WINDOW seconds
+  RATE_WINDOW = 60  # seconds
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._total = 0
+    self._seconds = deque()  # [second, count], oldest first, guarded by lock
+
+  def _expire(self, now):
+    # Must hold lock
+    while self._seconds and self._seconds[0][0] <= now - Counter.RATE_WINDOW:
+      self._seconds.popleft()
+
+  def incr(self, count=1):
+    second = int(time.time())
+    with self._lock:
+      self._total += count
+      if self._seconds and self._seconds[-1][0] == second:
+        self._seconds[-1][1] += count
+      else:
+        self._seconds.append([second, count])
+        self._expire(second)
+
+  def get_stats(self, uptime):
+    now = int(time.time())
+    with self._lock:
+      self._expire(now)
+      recent = sum(count for second, count in self._seconds)
+      total = self._total
+    return {
+      "total": total,
+      "per_sec": float(recent) / max(min(uptime, Counter.RATE_WINDOW), 1),
+    }
+
+class Histogram(object):
+  # Durations in seconds, counted in fixed buckets so recording is cheap. Percentiles are the
+  # upper bound of the bucket they fall in.
+  BUCKETS = [.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60]
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._counts = [0] * (len(Histogram.BUCKETS) + 1)  # last one is > BUCKETS[-1]
+    self._count = 0
+    self._sum = 0.
+    self._max = 0.
+
+  def observe(self, value):
+    i = bisect.bisect_left(Histogram.BUCKETS, value)
+    with self._lock:
+      self._counts[i] += 1
+      self._count += 1
+      self._sum += value
+      self._max = max(self._max, value)
+
+  def _percentile(self, counts, count, p):
+    rank = p * count
+    seen = 0
+    for i, n in enumerate(counts):
+      seen += n
+      if seen >= rank:
+        return Histogram.BUCKETS[i] if i < len(Histogram.BUCKETS) else float("inf")
+
+  def get_stats(self):
+    with self._lock:
+      counts = list(self._counts)
+      count, total, max_value = self._count, self._sum, self._max
+    if count == 0:
+      return {"count": 0}
+    return {
+      "count": count,
+      "mean": total / count,
+      "max": max_value,
+      "p50": self._percentile(counts, count, .5),
+      "p90": self._percentile(counts, count, .9),
+      "p99": self._percentile(counts, count, .99),
+      "buckets": dict(("%g" % bound, n) for bound, n in zip(Histogram.BUCKETS, counts) if n > 0),
+    }
+
+class Metrics(object):
+  # Process wide registry. Names are dotted, i.e "api.latency.match", and created on first use.
+  _lock = threading.Lock()
+  _counters = {}
+  _histograms = {}
+  _gauges = {}  # name -> fn returning the current value
+  _start = time.time()
+
+  @staticmethod
+  def _get(registry, name, cls):
+    metric = registry.get(name)
+    if metric is None:
+      with Metrics._lock:
+        metric = registry.setdefault(name, cls())
+    return metric
+
+  @staticmethod
+  def incr(name, count=1):
+    Metrics._get(Metrics._counters, name, Counter).incr(count)
+
+  @staticmethod
+  def observe(name, seconds):
+    Metrics._get(Metrics._histograms, name, Histogram).observe(seconds)
+
+  @staticmethod
+  def add_gauge(name, fn):
+    Metrics._gauges[name] = fn
+
+  @staticmethod
+  def timer(name):
+    return _Timer(name)
+
+  @staticmethod
+  def timed(name):
+    # Decorator, observes the duration of each call under name
+    def decorator(fn):
+      @functools.wraps(fn)
+      def wrapper(*args, **kwargs):
+        with _Timer(name):
+          return fn(*args, **kwargs)
+      return wrapper
+    return decorator
+
+  @staticmethod
+  def reset():
+    with Metrics._lock:
+      Metrics._counters.clear()
+      Metrics._histograms.clear()
+      Metrics._gauges.clear()
+      Metrics._start = time.time()
+
+  @staticmethod
+  def snapshot():
+    uptime = time.time() - Metrics._start
+    gauges = {}
+    for name, fn in Metrics._gauges.items():
+      try:
+        gauges[name] = fn()
+      except Exception as e:
+        gauges[name] = repr(e)
+    return {
+      "uptime": uptime,
+      "counters": dict((name, c.get_stats(uptime)) for name, c in Metrics._counters.items()),
+      "histograms": dict((name, h.get_stats()) for name, h in Metrics._histograms.items()),
+      "gauges": gauges,
+    }
+
+class _Timer(object):
+  def __init__(self, name):
+    self._name = name
+
+  def __enter__(self):
+    self._start = time.time()
+    return self
+
+  def __exit__(self, exc_type, exc, tb):
+    Metrics.observe(self._name, time.time() - self._start)
+    return False
@@ -0,0 +1,45 @@
+import threading
+
+from .metrics import Metrics
+
+class MetricsReporter(object):
+  # Prints a snapshot of Metrics every interval seconds
+  INTERVAL = 60  # seconds
+
+  def __init__(self, interval=INTERVAL):
+    self._interval = interval
+    self._is_running = False
+    self._stop_event = threading.Event()
+    self._thread = threading.Thread(target=self._run, name="METRICS")
+
+  @staticmethod
+  def format(snapshot):
+    lines = []
+    counters = snapshot["counters"]
+    if counters:
+      lines.append("[METRICS] Counts: " + ", ".join("%s %d (%.1f/s)" % (name, counters[name]["total"],
+        counters[name]["per_sec"]) for name in sorted(counters)))
+    gauges = snapshot["gauges"]
+    if gauges:
+      lines.append("[METRICS] Gauges: " + ", ".join("%s %s" % (name, gauges[name]) for name in sorted(gauges)))
+    histograms = snapshot["histograms"]
+    for name in sorted(histograms):
+      h = histograms[name]
+      if h["count"] > 0:
+        lines.append("[METRICS] Time %s: n=%d mean=%.1fms p50<=%gms p90<=%gms p99<=%gms max=%.1fms" % (name,
+          h["count"], h["mean"] * 1000, h["p50"] * 1000, h["p90"] * 1000, h["p99"] * 1000, h["max"] * 1000))
+    return "\n".join(lines)
+
+  def _run(self):
+    while self._is_running:
+      self._stop_event.wait(self._interval)
+      print MetricsReporter.format(Metrics.snapshot())
+
+  def start(self):
+    self._is_running = True
+    self._thread.start()
+
+  def stop(self):
+    self._is_running = False
+    self._stop_event.set()
+    self._thread.join()
@@ -0,0 +1,41 @@
+#!/usr/bin/python
+
+import sys
+import argparse
+import time
+
+from pymongo import MongoClient
+from bson import SON
+from bson.codec_options import CodecOptions
+
+from util import TriePruner
+
+def prune(outliers_db, input_name="builds", max_depth=TriePruner.MAX_DEPTH, min_count=TriePruner.MIN_COUNT,
+    query=None):
+  # Item order ties are broken by the order of items in a trie, so keep it by reading as SON
+  builds = outliers_db[input_name].with_options(codec_options=CodecOptions(document_class=SON))
+  return TriePruner(builds, max_depth, min_count).run(query)
+
+def main(argv):
+  mongo_url = "mongodb://localhost:27017"
+
+  parser = argparse.ArgumentParser(description='Prune the item tries of builds, folding rare item orders into "other"')
+  parser.add_argument("-i", default="builds", help="Collection of builds to prune")
+  parser.add_argument("-c", default=None, type=int, help="Only prune the builds of this champion")
+  parser.add_argument("--max_trie_depth", default=TriePruner.MAX_DEPTH, type=int, help="Max depth of item tries")
+  parser.add_argument("--min_branch_count", default=TriePruner.MIN_COUNT, type=int,
+    help="Fold item trie branches bought fewer times than this into 'other'")
+  parser.add_argument("--mongo", default=mongo_url, help="URL of MongoDB")
+  args = parser.parse_args()
+
+  # Initialize MongoDB
+  mongo_client = MongoClient(args.mongo)
+  outliers_db = mongo_client.outliers
+
+  start = time.time()
+  stats = prune(outliers_db, args.i, args.max_trie_depth, args.min_branch_count,
+    {"championId": args.c} if args.c is not None else None)
+  print "[PRUNE] Removed %d nodes from %d builds in %.1fs" % (stats["nodes"], stats["builds"], time.time() - start)
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
@@ -0,0 +1,158 @@
+#!/usr/bin/python
+
+from riot_api import RiotItems
+from db import BuildDb
+from util import BatchMatchProcessor
+
+import sys
+import argparse
+import signal
+import time
+import multiprocessing
+
+from pymongo import MongoClient
+
+BATCH_SIZE = 200  # matches per task
+REPORT_INTERVAL = 5  # seconds
+
+# Fields BatchMatchProcessor reads. Leaves out the is_final_item markers of earlier runs as well,
+# so the current item rules apply.
+MATCH_FIELDS = [
+  "matchId",
+  "matchVersion",
+  "participants.participantId",
+  "participants.championId",
+  "participants.spell1Id",
+  "participants.spell2Id",
+  "participants.runes",
+  "participants.masteries",
+  "participants.stats",
+  "participants.timeline.lane",
+  "participants.timeline.role",
+  "timeline.frames.events.eventType",
+  "timeline.frames.events.participantId",
+  "timeline.frames.events.itemId",
+  "timeline.frames.events.timestamp",
+  "timeline.frames.events.levelUpType",
+  "timeline.frames.events.skillSlot",
+]
+
+# Per process state, set up by init_worker since MongoClient can't be shared across a fork
+_matches = None
+_build_db = None
+_batch_processor = None
+
+def init_worker(mongo_url, patch, compact_keys, max_trie_depth):
+  global _matches, _build_db, _batch_processor
+  signal.signal(signal.SIGINT, signal.SIG_IGN)  # main process terminates the pool
+
+  outliers_db = MongoClient(mongo_url).outliers
+  _matches = outliers_db.matches
+  _build_db = BuildDb(outliers_db, compact_keys=compact_keys, max_trie_depth=max_trie_depth)
+  _batch_processor = BatchMatchProcessor(RiotItems(patch))
+
+def get_builds(matches):
+  # Participants of each match, or the exception processing it failed with
+  try:
+    return _batch_processor.get_builds_from_matches(matches)
+  except Exception:
+    # Redo the batch a match at a time, so only the match at fault fails
+    results = []
+    for match in matches:
+      try:
+        results.extend(_batch_processor.get_builds_from_matches([match]))
+      except Exception as e:
+        results.append(e)
+    return results
+
+def reprocess_batch(ids):
+  # Returns (# matches, # participants, # build documents written, # failed matches)
+  participants = []
+  n_matches = 0
+  n_failed = 0
+  matches = list(_matches.find({"_id": {"$in": ids}}, MATCH_FIELDS))
+  for match, match_participants in zip(matches, get_builds(matches)):
+    try:
+      if isinstance(match_participants, Exception):
+        raise match_participants
+      for p in match_participants:
+        build = p["build"]
+        if len(build["finalBuild"]) < 2:
+          continue
+        build["runes"] = _build_db.insert_runes(build["runes"])
+        build["masteries"] = _build_db.insert_masteries(build["masteries"])
+        build["skillups"] = _build_db.insert_skillups(build["skillups"])
+        participants.append(p)
+      n_matches += 1
+    except Exception as e:
+      print "!! Exception occurred for match: %r (%r)" % (match.get("matchId"), e)
+      n_failed += 1
+
+  return n_matches, len(participants), _build_db.insert_builds(participants), n_failed
+
+def batch_ids(matches, batch_size):
+  batch = []
+  for match in matches.find({"is_ref": False}, {"_id": 1}, no_cursor_timeout=True):
+    batch.append(match["_id"])
+    if len(batch) == batch_size:
+      yield batch
+      batch = []
+  if batch:
+    yield batch
+
+def main(argv):
+  mongo_url = "mongodb://localhost:27017"
+
+  parser = argparse.ArgumentParser(description='Rebuild builds, runes, masteries and skillups from stored matches')
+  parser.add_argument("-n", default=multiprocessing.cpu_count(), type=int, help="# of processes")
+  parser.add_argument("-b", default=BATCH_SIZE, type=int, help="# of matches per batch")
+  parser.add_argument("--patch", default=None, help="Patch to classify items with if a match's can't be loaded, i.e '5.16'")
+  parser.add_argument("--drop", action='store_true',
+    help="Drop builds, runes, masteries and skillups first and rebuild them from every stored match")
+  parser.add_argument("--append", action='store_true',
+    help="Add counts to existing builds instead. Every stored match is processed, so matches already counted in them are counted twice")
+  parser.add_argument("--compact_keys", action='store_true',
+    help="Use hashed/packed keys for builds, runes, masteries and skillups (smaller indexes)")
+  parser.add_argument("--max_trie_depth", default=None, type=int,
+    help="Only add the first N item purchases of a build to its item trie")
+  parser.add_argument("--mongo", default=mongo_url, help="URL of MongoDB")
+  args = parser.parse_args()
+
+  # Initialize MongoDB
+  mongo_client = MongoClient(args.mongo)
+  outliers_db = mongo_client.outliers
+  if args.drop:
+    for collection in ["builds", "build_groups", "runes", "masteries", "skillups"]:
+      outliers_db.drop_collection(collection)
+    print "[REPROCESS] Dropped builds, runes, masteries and skillups"
+  elif not args.append and outliers_db.builds.find_one({}, {"_id": 1}) is not None:
+    print "builds isn't empty and reprocessing would count its matches again. Use --drop to rebuild it or --append to add to it"
+    sys.exit(2)
+  BuildDb(outliers_db, compact_keys=args.compact_keys)  # indexes
+
+  # Make sure the item table is persisted before the workers load it
+  patch = RiotItems(args.patch).patch
+
+  pool = multiprocessing.Pool(args.n, init_worker, (args.mongo, patch, args.compact_keys, args.max_trie_depth))
+  totals = [0, 0, 0, 0]
+  start = time.time()
+  last_report = start
+  try:
+    for result in pool.imap_unordered(reprocess_batch, batch_ids(outliers_db.matches, args.b)):
+      totals = [t + r for t, r in zip(totals, result)]
+      now = time.time()
+      if now - last_report >= REPORT_INTERVAL:
+        last_report = now
+        print "[REPROCESS] %d matches, %.1f matches/sec" % (totals[0], totals[0] / (now - start))
+    pool.close()
+  except KeyboardInterrupt:
+    print "[STOP] Terminating workers"
+    pool.terminate()
+  pool.join()
+
+  elapsed = time.time() - start
+  print "[REPROCESS] Done: %d matches (%d failed), %d participants, %d build writes in %.1fs (%.1f matches/sec)" % (
+    totals[0], totals[3], totals[1], totals[2], elapsed, totals[0] / max(elapsed, 1e-6))
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
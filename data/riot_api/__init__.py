@@ -1,6 +1,7 @@
 from .api import RiotApi
 from .api_key import API_KEY
-from .scheduler import RiotApiScheduler
+from .scheduler import RiotApiScheduler, RateLimiter
 from .request import ApiRequest
 from .items import RiotItems
+from .response_cache import ResponseCache
     
\ No newline at end of file
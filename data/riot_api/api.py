@@ -1,33 +1,75 @@
 import urllib, json
 from .api_key import API_KEY
-from .exception import RiotRateLimitException, RiotApiException
+from .exception import RiotRateLimitException, RiotApiException, RiotCacheMissException
+from .http_pool import HttpConnectionPool
 
 class RiotApi(object):
   _API_KEY = API_KEY
-  _FORMAT_URL = "https://na.api.pvp.net/api/lol/{region}/v{version}/{endpoint}?{query_params}"
+  _BASE_URL = "https://na.api.pvp.net"
+  _FORMAT_URL = "{base_url}/api/lol/{region}/v{version}/{endpoint}?{query_params}"
+  _STATIC_FORMAT_URL = "{base_url}/api/lol/static-data/{region}/v1.2/{endpoint}?{query_params}"
   _REGION = "na"
   _DEFAULT_BACKOFF = 5
+  _DEFAULT_POOL_SIZE = 10
+  _response_listeners = []
+  _pool = HttpConnectionPool(_DEFAULT_POOL_SIZE)
+  _cache = None  # ResponseCache for immutable responses (matches)
 
   @staticmethod
   def set_api_key(key):
     RiotApi._API_KEY = key
 
+  @staticmethod
+  def set_base_url(url):
+    # i.e point at a local fake API (see fake_api.py) for load testing
+    RiotApi._BASE_URL = url.rstrip("/")
+
+  @staticmethod
+  def set_cache(cache):
+    RiotApi._cache = cache
+
+  @staticmethod
+  def set_pool_size(size):
+    # Number of keep-alive connections to hold on to, match to the # of threads making requests
+    RiotApi._pool.set_size(size)
+
+  @staticmethod
+  def close_connections():
+    RiotApi._pool.close()
+
+  @staticmethod
+  def add_response_listener(fn):
+    # fn(headers) is called with the headers of every response, i.e for rate limit info
+    RiotApi._response_listeners.append(fn)
+
+  @staticmethod
+  def _notify_listeners(headers):
+    for fn in RiotApi._response_listeners:
+      try:
+        fn(headers)
+      except Exception as e:
+        print "!! [API] Response listener exception: %r" % e
+
   @staticmethod
   def _get(full_url):
     # Raises RiotApiException
-    resp = urllib.urlopen(full_url)
-    status = resp.getcode()
+    return json.loads(RiotApi._get_raw(full_url))
+
+  @staticmethod
+  def _get_raw(full_url):
+    # Raises RiotApiException, returns the response body
+    resp = RiotApi._pool.get(full_url)
+    status = resp.status
+    RiotApi._notify_listeners(resp.headers)
     if status == 200:
-      data = json.loads(resp.read())
-      resp.close()
-      return data
+      return resp.body
     elif status == 429:
-      info = resp.info()
+      info = resp.headers
       limit_type = info.getheader("X-Rate-Limit-Type")
       retry_after = info.getheader("Retry-After") or RiotApi._DEFAULT_BACKOFF
       raise RiotRateLimitException(limit_type, float(retry_after))
     else:
-      raise RiotApiException(status, resp.info(), full_url)
+      raise RiotApiException(status, resp.headers, full_url)
 
   @staticmethod
   def _get_api_url(endpoint, version, query_params=None):
@@ -36,6 +78,7 @@ class RiotApi(object):
 
     query_params.update({"api_key": RiotApi._API_KEY})
     full_url = RiotApi._FORMAT_URL.format(
+      base_url=RiotApi._BASE_URL,
       region=RiotApi._REGION,
       version=version,
       endpoint=endpoint,
@@ -49,12 +92,44 @@ class RiotApi(object):
   ###
 
   @staticmethod
-  def get_match(match_id, includeTimeline=True):
+  def _get_match_cache_key(match_id, includeTimeline):
+    return "match/%s?includeTimeline=%s" % (match_id, includeTimeline)
+
+  @staticmethod
+  def get_cached_match_raw(match_id, includeTimeline=True):
+    # Returns None if there is no cache or the match isn't in it, never makes a request
+    if RiotApi._cache is None:
+      return None
+    return RiotApi._cache.get(RiotApi._get_match_cache_key(match_id, includeTimeline))
+
+  @staticmethod
+  def get_cached_match(match_id, includeTimeline=True):
+    body = RiotApi.get_cached_match_raw(match_id, includeTimeline)
+    return json.loads(body) if body is not None else None
+
+  @staticmethod
+  def get_match_raw(match_id, includeTimeline=True):
+    # Returns the response body, i.e to parse it somewhere else
+    cache_key = RiotApi._get_match_cache_key(match_id, includeTimeline)
+    if RiotApi._cache is not None:
+      body = RiotApi._cache.get(cache_key)
+      if body is not None:
+        return body
+      if RiotApi._cache.read_only:
+        raise RiotCacheMissException(cache_key)
+
     params = {
       "includeTimeline": includeTimeline
     }
     url = RiotApi._get_api_url("match/%s" % match_id, 2.2, params)
-    return RiotApi._get(url)
+    body = RiotApi._get_raw(url)
+    if RiotApi._cache is not None:
+      RiotApi._cache.put(cache_key, body)
+    return body
+
+  @staticmethod
+  def get_match(match_id, includeTimeline=True):
+    return json.loads(RiotApi.get_match_raw(match_id, includeTimeline))
 
   @staticmethod
   def get_matches(summoner_id, query_params=None):
@@ -68,9 +143,26 @@ class RiotApi(object):
     return RiotApi._get(url)
 
   @staticmethod
-  def get_all_items():
-    url = "https://na.api.pvp.net/api/lol/static-data/na/v1.2/item?api_key={api_key}&itemListData=into,from".format(
-      api_key=RiotApi._API_KEY
+  def get_versions():
+    # Static data versions, newest first
+    url = RiotApi._STATIC_FORMAT_URL.format(
+      base_url=RiotApi._BASE_URL,
+      region=RiotApi._REGION,
+      endpoint="versions",
+      query_params=urllib.urlencode({"api_key": RiotApi._API_KEY})
+    )
+    return RiotApi._get(url)
+
+  @staticmethod
+  def get_all_items(version=None):
+    query_params = {"api_key": RiotApi._API_KEY, "itemListData": "into,from"}
+    if version is not None:
+      query_params["version"] = version
+    url = RiotApi._STATIC_FORMAT_URL.format(
+      base_url=RiotApi._BASE_URL,
+      region=RiotApi._REGION,
+      endpoint="item",
+      query_params=urllib.urlencode(query_params)
     )
     return RiotApi._get(url)
 
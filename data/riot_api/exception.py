@@ -15,4 +15,22 @@ class RiotRateLimitException(Exception):
     self.limit_type = limit_type
 
   def __str__(self):
-    return "Riot API indicated rate limit reached, retry after: %r" % str(self.retry_after)
\ No newline at end of file
+    return "Riot API indicated rate limit reached, retry after: %r" % str(self.retry_after)
+
+class RiotCacheMissException(RiotApiException):
+  # Response not in the cache while replaying offline, no request was made
+  def __init__(self, key):
+    super(RiotCacheMissException, self).__init__(None, None, key)
+
+  def __str__(self):
+    return "Response not cached for %s (offline)" % self.url
+
+
+class RiotItemsException(Exception):
+  # Item data for the patch couldn't be fetched and isn't persisted either
+  def __init__(self, patch):
+    super(RiotItemsException, self).__init__()
+    self.patch = patch
+
+  def __str__(self):
+    return "No item data available for patch %r" % self.patch
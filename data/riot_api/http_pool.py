@@ -0,0 +1,115 @@
+import errno
+import httplib
+import socket
+import threading
+import urlparse
+import zlib
+
+
+class HttpResponse(object):
+
+  def __init__(self, status, headers, body):
+    self.status = status
+    self.headers = headers  # httplib.HTTPMessage, use getheader()
+    self.body = body
+
+
+class HttpConnectionPool(object):
+  # Keep-alive connections per (scheme, host, port), at most `size` idle ones are kept around.
+  # Should be sized to the number of threads making requests at once.
+  _CHUNK_SIZE = 64 * 1024
+  _TIMEOUT = 30  # seconds
+  _HEADERS = {
+    "Accept-Encoding": "gzip",
+    "Connection": "keep-alive",
+  }
+
+  # What a server closing an idle keep-alive connection looks like, as opposed to i.e a timeout
+  _DROPPED_ERRNOS = (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+  def __init__(self, size):
+    self._size = size
+    self._lock = threading.Lock()
+    self._idle = {}  # (scheme, host, port) -> [connection], guarded by lock
+
+  def set_size(self, size):
+    with self._lock:
+      self._size = size
+
+  def _get_connection(self, key):
+    with self._lock:
+      idle = self._idle.get(key)
+      if idle:
+        return idle.pop()
+
+    scheme, host, port = key
+    if scheme == "https":
+      return httplib.HTTPSConnection(host, port, timeout=HttpConnectionPool._TIMEOUT)
+    return httplib.HTTPConnection(host, port, timeout=HttpConnectionPool._TIMEOUT)
+
+  def _release_connection(self, key, conn):
+    with self._lock:
+      idle = self._idle.setdefault(key, [])
+      if len(idle) < self._size:
+        idle.append(conn)
+        return
+    conn.close()
+
+  def _read_body(self, resp):
+    # Decompress while reading instead of buffering the whole compressed payload first
+    encoding = (resp.getheader("Content-Encoding") or "").lower()
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if encoding == "gzip" else None
+
+    chunks = []
+    while True:
+      chunk = resp.read(HttpConnectionPool._CHUNK_SIZE)
+      if not chunk:
+        break
+      chunks.append(decompressor.decompress(chunk) if decompressor else chunk)
+    if decompressor:
+      chunks.append(decompressor.flush())
+    return "".join(chunks)
+
+  @staticmethod
+  def _is_dropped(e):
+    if isinstance(e, httplib.BadStatusLine):
+      return True
+    return isinstance(e, socket.error) and not isinstance(e, socket.timeout) and \
+      e.errno in HttpConnectionPool._DROPPED_ERRNOS
+
+  def get(self, url):
+    # Raises httplib.HTTPException or socket.error if the request couldn't be made, zlib.error if
+    # the response couldn't be decompressed
+    parts = urlparse.urlsplit(url)
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    key = (parts.scheme, parts.hostname, port)
+    path = parts.path + ("?" + parts.query if parts.query else "")
+
+    for attempt in xrange(2):
+      conn = self._get_connection(key)
+      is_reused = conn.sock is not None
+      try:
+        conn.request("GET", path, headers=HttpConnectionPool._HEADERS)
+        resp = conn.getresponse()
+        body = self._read_body(resp)
+      except (httplib.HTTPException, socket.error) as e:
+        conn.close()
+        if is_reused and attempt == 0 and HttpConnectionPool._is_dropped(e):
+          continue  # server dropped the idle connection, retry once on a fresh one
+        raise
+      except zlib.error:
+        conn.close()  # rest of the body is still unread
+        raise
+
+      if resp.will_close:
+        conn.close()
+      self._release_connection(key, conn)
+      return HttpResponse(resp.status, resp.msg, body)
+
+  def close(self):
+    with self._lock:
+      idle = self._idle
+      self._idle = {}
+    for conns in idle.itervalues():
+      for conn in conns:
+        conn.close()
@@ -1,6 +1,21 @@
+import json
+import os
+import threading
+
 from .api import RiotApi
+from .exception import RiotItemsException
 
 class RiotItems(object):
+  # Item data for a single patch, precomputed into a compact table that is persisted under
+  # TABLE_DIR (one file per patch) so startup doesn't need the API unless the patch changed
+  TABLE_DIR = os.path.expanduser("~/.outliers/item_tables")
+  _TABLE_FORMAT = 1
+
+  # Precomputed flags per item
+  FINAL = 1
+  UPGRADED = 2
+  UPGRADEABLE = 4
+  POTION_OR_TRINKET = 8
 
   # For certain items to be considered final, despite being upgradeable
   _FINAL_ITEM_WHITELIST = [
@@ -44,26 +59,224 @@ class RiotItems(object):
     2041
   ]
 
+  _POTION_OR_TRINKET = [
+    2004,
+    2003,
+    2044,
+    2043,
+    2140,
+    2139,
+    2138,
+    2137,
+    2009,
+    2010,
+    3599, # kalista spear thing
+    3340,
+    3341,
+    3342,
+    3361,
+    3362,
+    3363,
+    3364,
+  ]
+
+  _POTION_OR_TRINKET_SET = frozenset(_POTION_OR_TRINKET)
+
   _GROUP_BLACKLIST = [
     "GangplankRUpgrade",
     "Boots"
   ]
 
-  def __init__(self):
+  # patch -> RiotItems, shared so each patch is loaded once per process
+  _by_patch = {}
+  _by_patch_lock = threading.Lock()
+
+  def __init__(self, patch=None, table_dir=None):
+    # Loads the table for the given patch ("5.16"), or the current patch if None.
+    # Raises RiotItemsException if there is neither a persisted table nor a working API.
+    self._table_dir = table_dir or RiotItems.TABLE_DIR
+    table = self._load_or_build_table(patch)
+    self.version = table["version"]
+    self.patch = table["patch"]
+    self._items = table["items"]
+    self._build_lookups()
+
+  def _build_lookups(self):
+    # Everything keyed by int item id, so classifying an item is a single dict/set lookup
+    self._flags = dict((int(iid), item["flags"]) for iid, item in self._items.iteritems())
+    for iid in RiotItems._POTION_OR_TRINKET:
+      self._flags[iid] = self._flags.get(iid, 0) | RiotItems.POTION_OR_TRINKET
+    self._components = dict((int(iid), tuple(int(c) for c in item["from"]))
+      for iid, item in self._items.iteritems() if "from" in item)
+
+    def with_flag(flag):
+      return frozenset(iid for iid, flags in self._flags.iteritems() if flags & flag)
+    self._final_items = with_flag(RiotItems.FINAL)
+    self._upgraded_items = with_flag(RiotItems.UPGRADED)
+    self._upgradeable_items = with_flag(RiotItems.UPGRADEABLE)
+
+  ###
+  # Table building and persistence
+  #
+  ###
+
+  @staticmethod
+  def get_patch(version):
+    # "5.16.0.294" (matchVersion) or "5.16.1" (static data version) -> "5.16"
+    return ".".join(version.split(".")[:2])
+
+  def _get_table_path(self, patch):
+    return os.path.join(self._table_dir, "%s.json" % patch)
+
+  def _get_persisted_patches(self):
+    if not os.path.exists(self._table_dir):
+      return []
+    patches = [f[:-len(".json")] for f in os.listdir(self._table_dir) if f.endswith(".json")]
+    return sorted(patches, key=lambda p: [int(n) for n in p.split(".") if n.isdigit()], reverse=True)
+
+  def _read_table(self, patch):
+    path = self._get_table_path(patch)
+    if not os.path.exists(path):
+      return None
+    with open(path) as f:
+      table = json.load(f)
+    if table.get("format") != RiotItems._TABLE_FORMAT:
+      return None  # built by an older version of this code, rebuild
+    return table
+
+  def _write_table(self, table):
+    if not os.path.exists(self._table_dir):
+      os.makedirs(self._table_dir)
+    path = self._get_table_path(table["patch"])
+    # Per thread, since threads loading a new patch at once (see for_version) may all write it
+    tmp_path = "%s.%d-%d.tmp" % (path, os.getpid(), threading.current_thread().ident)
+    with open(tmp_path, "w") as f:
+      json.dump(table, f, separators=(",", ":"))
+    os.rename(tmp_path, path)
+
+  def _find_version(self, patch):
+    # Static data version for the patch, None for the latest
+    versions = RiotApi.get_versions()
+    if patch is None:
+      return versions[0]
+    for version in versions:
+      if RiotItems.get_patch(version) == patch:
+        return version
+    return None
+
+  def _load_or_build_table(self, patch):
+    if patch is not None:
+      table = self._read_table(patch)
+      if table is not None:
+        return table
+
     try:
-      self._items = RiotApi.get_all_items()["data"]
+      version = self._find_version(patch)
+      if version is not None:
+        patch = RiotItems.get_patch(version)
+        table = self._read_table(patch)
+        if table is None:
+          print "[ITEMS] Fetching items for patch %s" % patch
+          table = RiotItems._build_table(RiotApi.get_all_items(version)["data"], version)
+          self._write_table(table)
+        return table
+      print "!! [ITEMS] No item data for patch %r" % patch
     except Exception as e:
       print "!! [ITEMS] Exception: %r" % e
 
+    # API unavailable, fall back to the newest table we have
+    for persisted in self._get_persisted_patches():
+      table = self._read_table(persisted)
+      if table is not None:
+        print "!! [ITEMS] Using persisted items for patch %s instead of %r" % (persisted, patch)
+        return table
+    raise RiotItemsException(patch)
+
+  @staticmethod
+  def _build_table(items, version):
+    # Applies the white/blacklists and precomputes the flags for every item
+    items = dict((iid, {
+      "name": item.get("name"),
+      "from": item.get("from"),
+      "into": item.get("into"),
+      "group": item.get("group"),
+    }) for iid, item in items.iteritems())
+    for item in items.itervalues():
+      for key in item.keys():
+        if item[key] is None:
+          del item[key]
+
     for iid in RiotItems._FINAL_ITEM_BLACKLIST:
       iid = str(iid)
-      self._items[iid]["into"] = []
+      if iid in items:
+        items[iid]["into"] = []
 
     for iid in RiotItems._FINAL_ITEM_WHITELIST:
       iid = str(iid)
-      upgrade = self._items[iid]["into"]
-      del self._items[iid]["into"]
-      self._items[iid]["upgradeInto"] = upgrade
+      if iid in items:
+        upgrade = items[iid].pop("into", [])
+        items[iid]["upgradeInto"] = upgrade
+
+    def in_group_blacklist(iid):
+      item = items.get(iid)
+      if item is None or "group" not in item:
+        return False
+      for group in RiotItems._GROUP_BLACKLIST:
+        if group in item["group"]:
+          return True
+      return False
+
+    def is_final(iid):
+      return iid in items and not in_group_blacklist(iid) and "into" not in items[iid]
+
+    for iid, item in items.iteritems():
+      flags = 0
+      if is_final(iid):
+        flags |= RiotItems.FINAL
+      if any(is_final(from_iid) for from_iid in item.get("from", [])):
+        flags |= RiotItems.UPGRADED
+      if "upgradeInto" in item and not any(in_group_blacklist(into) for into in item["upgradeInto"]):
+        flags |= RiotItems.UPGRADEABLE
+      if int(iid) in RiotItems._POTION_OR_TRINKET:
+        flags |= RiotItems.POTION_OR_TRINKET
+      item["flags"] = flags
+
+    return {
+      "format": RiotItems._TABLE_FORMAT,
+      "version": version,
+      "patch": RiotItems.get_patch(version),
+      "items": items,
+    }
+
+  def for_version(self, match_version):
+    # Items for the patch a match was played on, i.e match["matchVersion"]. Falls back to
+    # these items if that patch can't be loaded.
+    if match_version is None:
+      return self
+    patch = RiotItems.get_patch(match_version)
+    if patch == self.patch:
+      return self
+
+    items = RiotItems._by_patch.get(patch)
+    if items is not None:
+      return items
+
+    # Loaded outside the lock, which may mean a fetch from the API, so other threads aren't held up.
+    # Threads loading the same patch at once all use whichever table was stored first.
+    try:
+      items = RiotItems(patch, self._table_dir)
+      if items.patch != patch:
+        raise RiotItemsException(patch)  # fell back to another persisted patch
+    except RiotItemsException as e:
+      print "!! [ITEMS] %s, using patch %s" % (e, self.patch)
+      items = self
+    with RiotItems._by_patch_lock:
+      return RiotItems._by_patch.setdefault(patch, items)
+
+  ###
+  # Public Methods
+  #
+  ###
 
   def get_item(self, iid):
     if iid in self._items:
@@ -71,72 +284,28 @@ class RiotItems(object):
     else:
       return None
 
-  def is_final_item(self, iid):
-    item = self.get_item(iid)
-    if item is None:
-      return False
+  def get_flags(self, iid):
+    # Fast path, takes an int id and returns FINAL | UPGRADED | ... (0 for unknown items)
+    return self._flags.get(iid, 0)
 
-    # Avoid gangplank items
-    if "group" in item:
-      for group in RiotItems._GROUP_BLACKLIST:
-        if group in item["group"]:
-          return False
+  def get_components(self, iid):
+    # Fast path, takes an int id and returns the int ids it is built from
+    return self._components.get(iid, ())
 
-    return ("into" not in item)
+  def get_item_ids(self):
+    # Int ids of every item get_flags knows, incl. potions and trinkets missing from the item data
+    return self._flags.keys()
 
-  def is_upgraded_item(self, iid):
-    item = self.get_item(iid)
-    if item is None:
-      return False
-
-    fromItems = item["from"] if "from" in item else None
-    if fromItems is not None:
-      for from_iid in fromItems:
-        if self.is_final_item(from_iid): return True
+  def is_final_item(self, iid):
+    return int(iid) in self._final_items
 
-    return False
+  def is_upgraded_item(self, iid):
+    return int(iid) in self._upgraded_items
 
   def is_item_upgradeable(self, iid):
     # Mainly used to avoid considering boot upgrades
-    item = self.get_item(iid)
-    if item is None:
-      return False
-
-    if "upgradeInto" in item:
-      for intoItem in item["upgradeInto"]:
-        if self._is_in_group_blacklist(intoItem):
-          return False
-      return True
-    else:
-      return False
-
-  def _is_in_group_blacklist(self, iid):
-    item = self.get_item(iid)
-    if "group" in item:
-      for group in RiotItems._GROUP_BLACKLIST:
-        if group in item["group"]:
-          return True
-    return False
+    return int(iid) in self._upgradeable_items
 
   def is_potion_or_trinket(self, iid):
-    return int(iid) in [
-      2004,
-      2003,
-      2044,
-      2043,
-      2140,
-      2139,
-      2138,
-      2137,
-      2009,
-      2010,
-      3599, # kalista spear thing
-      3340,
-      3341,
-      3342,
-      3361,
-      3362,
-      3363,
-      3364,
-    ]
+    return int(iid) in RiotItems._POTION_OR_TRINKET_SET
 
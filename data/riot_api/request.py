@@ -2,25 +2,59 @@ import threading
 import time
 
 class ApiRequest(object):
+  # Request classes, each gets its own lane in the scheduler
+  MATCH = "match"
+  MATCHLIST = "matchlist"
+  LEAGUE = "league"
+  STATIC = "static"
 
-  def __init__(self, api_fn):
+  def __init__(self, api_fn, request_class=STATIC, priority=0):
     self._api_fn = api_fn
+    self.request_class = request_class
+    self.priority = priority  # higher goes first within a class
 
     self._done_event = threading.Event()
     self._done_event.clear()
     self._data = None
     self._timestamp = None
+    self._created = time.time()
+    self._latency = None
+    self._callbacks = []
+    self._callbacks_lock = threading.Lock()
+
+  def _set_done(self):
+    with self._callbacks_lock:
+      self._done_event.set()
+      callbacks = self._callbacks
+      self._callbacks = []
+    for fn in callbacks:
+      fn(self)
 
   def execute(self):
     # Could raise RiotApiException or RiotRateLimitException
     if not self._done_event.is_set():
-      self._timestamp = int(time.time() * 1000)
-      self._data = self._api_fn()
-      self._done_event.set()
+      start = time.time()
+      self._timestamp = int(start * 1000)
+      try:
+        self._data = self._api_fn()
+      finally:
+        self._latency = time.time() - start
+      self._set_done()
 
   def mark_invalid(self):
     self._data = None
-    self._done_event.set()
+    self._set_done()
+
+  def add_done_callback(self, fn):
+    # fn(request) is called once the request is done or invalid, on the thread that finished it
+    with self._callbacks_lock:
+      if not self._done_event.is_set():
+        self._callbacks.append(fn)
+        return
+    fn(self)
+
+  def is_done(self):
+    return self._done_event.is_set()
 
   def wait(self, timeout=None):
     return self._done_event.wait(timeout)
@@ -29,4 +63,12 @@ class ApiRequest(object):
     return self._data
 
   def get_timestamp(self):
-    return self._timestamp
\ No newline at end of file
+    return self._timestamp
+
+  def get_latency(self):
+    # Seconds api_fn took, None if it wasn't executed
+    return self._latency
+
+  def get_age(self):
+    # Seconds since the request was created, i.e time spent waiting for the scheduler
+    return time.time() - self._created
@@ -0,0 +1,121 @@
+import gzip
+import hashlib
+import os
+import threading
+import time
+
+
+class ResponseCache(object):
+  # Raw API responses on local disk, gzipped, one file per key (i.e "match/1234?timeline=True").
+  # Least recently used files are evicted once the cache grows past max_bytes.
+  # A read only cache never writes or evicts, i.e for replaying stored responses offline.
+  DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+  _COMPRESS_LEVEL = 6
+
+  def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES, read_only=False):
+    self._dir = directory
+    self._max_bytes = max_bytes
+    self.read_only = read_only
+
+    self._lock = threading.Lock()
+    self._entries = {}  # path -> [size, last access], guarded by lock
+    self._total_bytes = 0  # guarded by lock
+    self.hits = 0
+    self.misses = 0
+
+    if not os.path.exists(directory) and not read_only:
+      os.makedirs(directory)
+    self._load_index()
+
+  def _load_index(self):
+    for root, dirs, files in os.walk(self._dir):
+      for name in files:
+        if not name.endswith(".json.gz"):
+          continue
+        path = os.path.join(root, name)
+        stat = os.stat(path)
+        self._entries[path] = [stat.st_size, stat.st_mtime]
+        self._total_bytes += stat.st_size
+
+  def _get_path(self, key):
+    digest = hashlib.sha1(key).hexdigest()
+    return os.path.join(self._dir, digest[:2], digest + ".json.gz")
+
+  def get(self, key):
+    # Returns the raw response body or None
+    path = self._get_path(key)
+    with self._lock:
+      entry = self._entries.get(path)
+      if entry is None:
+        self.misses += 1
+        return None
+      entry[1] = time.time()
+      self.hits += 1
+
+    try:
+      with gzip.open(path, "rb") as f:
+        body = f.read()
+    except IOError:
+      # Evicted by another thread or corrupt, treat as a miss
+      with self._lock:
+        self._forget(path)
+      return None
+
+    if not self.read_only:
+      try:
+        os.utime(path, None)  # keeps LRU order across restarts
+      except OSError:
+        pass
+    return body
+
+  def put(self, key, body):
+    if self.read_only:
+      return
+    path = self._get_path(key)
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+      try:
+        os.makedirs(directory)
+      except OSError:
+        pass  # created by another thread
+
+    # Write to temp file first so readers never see a partial file
+    tmp_path = "%s.%d.tmp" % (path, threading.current_thread().ident)
+    with gzip.GzipFile(tmp_path, "wb", ResponseCache._COMPRESS_LEVEL) as f:
+      f.write(body)
+    os.rename(tmp_path, path)
+
+    size = os.path.getsize(path)
+    with self._lock:
+      self._forget(path)
+      self._entries[path] = [size, time.time()]
+      self._total_bytes += size
+      if self._total_bytes > self._max_bytes:
+        self._evict()
+
+  def _forget(self, path):
+    # Must hold lock
+    entry = self._entries.pop(path, None)
+    if entry is not None:
+      self._total_bytes -= entry[0]
+
+  def _evict(self):
+    # Must hold lock, evicts least recently used down to 90% of the cap
+    target = self._max_bytes * .9
+    for path, entry in sorted(self._entries.iteritems(), key=lambda e: e[1][1]):
+      if self._total_bytes <= target:
+        break
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+      self._forget(path)
+
+  def get_stats(self):
+    with self._lock:
+      return {
+        "entries": len(self._entries),
+        "bytes": self._total_bytes,
+        "hits": self.hits,
+        "misses": self.misses,
+      }
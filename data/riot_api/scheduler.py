@@ -1,79 +1,318 @@
 import threading
 import functools
-from Queue import Queue, Empty, Full
+import heapq
+import itertools
+import time
+from collections import deque
+from Queue import Full
 from concurrent.futures import ThreadPoolExecutor
 
+from metrics import Metrics
+
+from .api import RiotApi
 from .exception import RiotApiException, RiotRateLimitException
 
-class RiotApiScheduler(object):
-  MAX_QSIZE = 25
-  REQ_PER_MIN = 50
-  _DEFAULT_DUPE_BACKOFF = 1
 
-  def __init__(self):
-    self._timer = threading.Timer(0, self._run)
+class RateLimitWindow(object):
+  # Sliding window of send times, i.e at most `limit` requests per `seconds`
+  MARGIN = .25  # seconds, slack for network jitter between our send time and the server's receive time
+
+  def __init__(self, limit, seconds, margin=MARGIN):
+    self.limit = limit
+    self.seconds = seconds
+    self._margin = margin
+    self._sent = deque()
+
+  def _expire(self, now):
+    while self._sent and self._sent[0] + self.seconds + self._margin <= now:
+      self._sent.popleft()
+
+  def delay(self, now):
+    # Seconds until this window has room for another request
+    self._expire(now)
+    if len(self._sent) < self.limit:
+      return 0
+    return self._sent[len(self._sent) - self.limit] + self.seconds + self._margin - now
+
+  def record(self, now):
+    self._sent.append(now)
+
+  def sync_count(self, count, now):
+    # Server saw more requests than we did (restart, other process on same key), catch up
+    self._expire(now)
+    while len(self._sent) < count:
+      self._sent.append(now)
+
+
+class RateLimiter(object):
+  # Tracks several windows at once, a request may only go out when all of them have room
+
+  def __init__(self, limits, margin=RateLimitWindow.MARGIN):
+    self._margin = margin
     self._lock = threading.Lock()
-    self._executor = ThreadPoolExecutor(max_workers=5)
-    self._queue = Queue(maxsize=RiotApiScheduler.MAX_QSIZE)
+    self._windows = {}  # seconds -> RateLimitWindow, guarded by lock
+    self._blocked_until = 0  # guarded by lock
+    self.set_limits(limits)
+
+  def set_limits(self, limits):
+    with self._lock:
+      windows = {}
+      for limit, seconds in limits:
+        window = self._windows.get(seconds) or RateLimitWindow(limit, seconds, self._margin)
+        window.limit = limit
+        windows[seconds] = window
+      self._windows = windows
+
+  def get_limits(self):
+    with self._lock:
+      return sorted([(w.limit, w.seconds) for w in self._windows.itervalues()], key=lambda l: l[1])
+
+  def get_counts(self):
+    with self._lock:
+      now = time.time()
+      for window in self._windows.itervalues():
+        window.delay(now)  # expires old sends
+      return sorted([(len(w._sent), w.seconds) for w in self._windows.itervalues()], key=lambda l: l[1])
+
+  def delay(self):
+    with self._lock:
+      now = time.time()
+      delay = self._blocked_until - now
+      for window in self._windows.itervalues():
+        delay = max(delay, window.delay(now))
+      return max(delay, 0)
+
+  def acquire(self):
+    # Returns True and records a send if every window has room
+    with self._lock:
+      now = time.time()
+      if self._blocked_until > now:
+        return False
+      for window in self._windows.itervalues():
+        if window.delay(now) > 0:
+          return False
+      for window in self._windows.itervalues():
+        window.record(now)
+      return True
+
+  def backoff(self, seconds):
+    with self._lock:
+      self._blocked_until = max(self._blocked_until, time.time() + seconds)
+
+  @staticmethod
+  def parse_header(value):
+    # "10:10,500:600" -> [(10, 10), (500, 600)]
+    pairs = []
+    for pair in value.split(","):
+      try:
+        num, seconds = pair.strip().split(":")
+        pairs.append((int(num), int(seconds)))
+      except ValueError:
+        continue
+    return pairs
+
+  def update_from_headers(self, headers):
+    # Learn limits and current counts from response headers, if the server sends them
+    limits = headers.getheader("X-App-Rate-Limit") or headers.getheader("X-Rate-Limit")
+    if limits:
+      limits = sorted(RateLimiter.parse_header(limits), key=lambda l: l[1])  # same order as get_limits
+      if limits and limits != self.get_limits():
+        print "[API Rate Limit] Learned limits from headers: %r" % limits
+        self.set_limits(limits)
+
+    counts = headers.getheader("X-App-Rate-Limit-Count") or headers.getheader("X-Rate-Limit-Count")
+    if counts:
+      with self._lock:
+        now = time.time()
+        for count, seconds in RateLimiter.parse_header(counts):
+          if seconds in self._windows:
+            self._windows[seconds].sync_count(count, now)
+
+
+class RequestLane(object):
+  # Bounded priority queue for one class of requests, guarded by the scheduler's condition
+
+  def __init__(self, maxsize):
+    self.maxsize = maxsize
+    self.weight = 1
+    self.current_weight = 0  # for smooth weighted round robin
+    self._heap = []
+
+  def __len__(self):
+    return len(self._heap)
+
+  def is_full(self):
+    return len(self._heap) >= self.maxsize
+
+  def put(self, req, seq):
+    heapq.heappush(self._heap, (-req.priority, seq, req))
+
+  def pop(self):
+    return heapq.heappop(self._heap)[2]
+
+
+class RiotApiScheduler(object):
+  MAX_QSIZE = 25  # per request class
+  RATE_LIMITS = [(10, 10), (500, 600)]  # (requests, seconds), default dev key limits
+  EXECUTOR_SIZE = 10
+  _MAX_SLEEP = .1  # seconds, so stop() and new limits are picked up quickly
+  _QUEUE_TIMEOUT = .3  # seconds
+
+  def __init__(self, rate_limits=None, executor_size=None, weight_fn=None):
+    self._thread = threading.Thread(target=self._run, name="API_SCHEDULER")
+    executor_size = executor_size or RiotApiScheduler.EXECUTOR_SIZE
+    self._executor = ThreadPoolExecutor(max_workers=executor_size)
+    self._free_threads = threading.Semaphore(executor_size)  # so send time ~= time recorded by the limiter
+    self._rate_limiter = RateLimiter(rate_limits or RiotApiScheduler.RATE_LIMITS)
+
+    self._cond = threading.Condition()
+    self._lanes = {}  # request class -> RequestLane, guarded by cond
+    self._seq = itertools.count()  # FIFO order among equal priorities
+    self._weight_fn = weight_fn  # () -> {request class: weight}, polled before each pick
 
     self._is_running = False
-    self._backoff = None  # guarded by lock
-    self._next_sleep = 60.0 / RiotApiScheduler.REQ_PER_MIN  # initial sleep period
+    RiotApi.set_pool_size(executor_size)
+    RiotApi.add_response_listener(self._rate_limiter.update_from_headers)
 
   def _process_request(self, req):
     try:
+      Metrics.observe("api.queued." + req.request_class, req.get_age())
       try:
         req.execute()
+        Metrics.incr("api.requests." + req.request_class)
       except RiotRateLimitException as e:
         print "!! [API Rate Limit] Type: %r, Retry after: %r" % (e.limit_type, e.retry_after)
-        with self._lock:
-          if self._backoff == None:
-            self._backoff = e.retry_after
-          else:
-            self.backoff = RiotApiScheduler._DEFAULT_DUPE_BACKOFF
+        Metrics.incr("api.429." + req.request_class)
+        Metrics.incr("api.backoff_secs", e.retry_after)
+        self._rate_limiter.backoff(e.retry_after)
         req.mark_invalid()
       except RiotApiException as e:
         print "!! [API Exception] Code: %r for url: %r" % (e.status_code, e.url)
+        Metrics.incr("api.errors." + req.request_class)
         req.mark_invalid()
       except Exception as e:
+        # i.e connection errors, don't leave the worker waiting on the request forever
         print "!! [RANDOM EXCEPTION] %r" % e
+        Metrics.incr("api.errors." + req.request_class)
+        req.mark_invalid()
+      if req.get_latency() is not None:
+        Metrics.observe("api.latency." + req.request_class, req.get_latency())
     except Exception as e:
       print "!! [RANDOM EXCEPTION] %r" % e
+    finally:
+      self._free_threads.release()
 
-  def _run(self):
-    # TODO optimize to take better advantage of api limit
-    # Pull requests off per rate limit and schedule them with thread pool executor
+  def _wait_for_token(self, acquire):
+    # Blocks until every rate limit window has room, returns False if stopped
+    while self._is_running:
+      if acquire and self._rate_limiter.acquire():
+        return True
+      delay = self._rate_limiter.delay()
+      if not acquire and delay <= 0:
+        return True
+      sleep = min(max(delay, .001), RiotApiScheduler._MAX_SLEEP)
+      time.sleep(sleep)
+      Metrics.incr("api.rate_limited_secs", sleep)  # per_sec near 1 means the rate limit is the bottleneck
+    return False
+
+  def _get_lane(self, request_class):
+    # Must hold cond
+    if request_class not in self._lanes:
+      self._lanes[request_class] = RequestLane(RiotApiScheduler.MAX_QSIZE)
+    return self._lanes[request_class]
+
+  def _update_weights(self):
+    if self._weight_fn is None:
+      return
     try:
-      req = self._queue.get(False)
-      self._executor.submit(self._process_request, req)
-    except Empty:
-      pass
+      weights = self._weight_fn()
+    except Exception as e:
+      print "!! [API SCHEDULER] Weight function exception: %r" % e
+      return
+    with self._cond:
+      for request_class, weight in weights.iteritems():
+        self._get_lane(request_class).weight = max(weight, 0)
 
-    if self._is_running:
-      delay = self._next_sleep
-      with self._lock:
-        if self._backoff:
-          delay = self._backoff
-          self._backoff = None
+  def _pick_lane(self):
+    # Smooth weighted round robin over non-empty lanes, must hold cond
+    lanes = [lane for lane in self._lanes.itervalues() if len(lane) > 0]
+    if not lanes:
+      return None
+    if all(lane.weight <= 0 for lane in lanes):
+      return max(lanes, key=len)
 
-      self._timer = threading.Timer(delay, self._run)
-      self._timer.start()
-    return
+    total = 0
+    for lane in lanes:
+      lane.current_weight += lane.weight
+      total += lane.weight
+    best = max(lanes, key=lambda l: l.current_weight)
+    best.current_weight -= total
+    return best
 
-  def add_request(self, req, timeout=1):
-    # should block if full, raises Full exception if times out
+  def _next_request(self):
+    self._update_weights()
+    with self._cond:
+      lane = self._pick_lane()
+      if lane is None:
+        self._cond.wait(RiotApiScheduler._QUEUE_TIMEOUT)
+        lane = self._pick_lane()
+        if lane is None:
+          return None
+      req = lane.pop()
+      self._cond.notify_all()
+      return req
+
+  def _run(self):
+    # Send requests in bursts as long as every window has room, then wait for the oldest to expire.
+    # Lane is only picked once there is room so the mix reflects the latest weights.
     while self._is_running:
-      try:
-        self._queue.put(req, True, timeout)
-        return
-      except Full:
+      if not self._free_threads.acquire(False):
+        time.sleep(.001)
+        continue
+      if not self._wait_for_token(acquire=False):
+        break
+      req = self._next_request()
+      if req is None:
+        self._free_threads.release()
         continue
+      if not self._wait_for_token(acquire=True):
+        req.mark_invalid()
+        break
+      self._executor.submit(self._process_request, req)
+
+  def get_rate_limits(self):
+    return self._rate_limiter.get_limits()
+
+  def qsize(self, request_class=None):
+    with self._cond:
+      if request_class is not None:
+        return len(self._lanes[request_class]) if request_class in self._lanes else 0
+      return sum(len(lane) for lane in self._lanes.itervalues())
+
+  def add_request(self, req, timeout=1):
+    # should block if lane for the request's class is full, raises Full exception if times out
+    with self._cond:
+      lane = self._get_lane(req.request_class)
+      if lane.is_full():
+        self._cond.wait(timeout)
+        if lane.is_full():
+          raise Full
+      lane.put(req, next(self._seq))
+      self._cond.notify_all()
+
+  def is_alive(self):
+    return self._thread.is_alive()
 
   def start(self):
     self._is_running = True
-    self._timer.start()
+    self._thread.start()
 
   def stop(self):
     self._is_running = False
+    self._thread.join()
+    with self._cond:
+      for lane in self._lanes.itervalues():
+        while len(lane) > 0:
+          lane.pop().mark_invalid()
     self._executor.shutdown(wait=True)
-    self._timer.cancel()
+    RiotApi.close_connections()
@@ -1,5 +1,13 @@
 import datetime
 from .match_processor import MatchProcessor
+from .batch_processor import BatchMatchProcessor
+from .match_pool import MatchProcessorPool, process_match
+from .item_trie import ItemTrie
+from .trie_pruner import TriePruner
+from .build_consolidator import BuildConsolidator
+from .build_finalizer import BuildFinalizer
+from .refresher import Refresher
+from .status_server import StatusServer
 
 def datetime_to_timestamp(dt):
   return int((dt - datetime.datetime(1970,1,1)).total_seconds() * 1000)
\ No newline at end of file
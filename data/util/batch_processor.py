@@ -0,0 +1,315 @@
+import itertools
+import operator
+import numpy as np
+
+from riot_api import RiotItems
+
+class BatchMatchProcessor(object):
+  # Same output as MatchProcessor.get_builds_from_match, but for a batch of matches at a time.
+  # The item and skill events of the batch are picked out of the timelines with list
+  # comprehensions and turned into numpy columns, then undos, sells and purchases are resolved
+  # with array operations instead of a per event state machine. Unlike MatchProcessor, item events
+  # in the input matches are not modified (no zero padding or is_final_item markers).
+
+  # Event codes, other events are skipped
+  _PURCHASED = 1
+  _SOLD = 2
+  _UNDO = 3
+  _SKILL = 4
+  _EVENT_CODES = {
+    u"ITEM_PURCHASED": _PURCHASED,
+    u"ITEM_SOLD": _SOLD,
+    u"ITEM_UNDO": _UNDO,
+    u"SKILL_LEVEL_UP": _SKILL,
+  }
+
+  _MAX_PARTICIPANTS = 16  # group id = match index * _MAX_PARTICIPANTS + participant id
+
+  def __init__(self, itemDb):
+    self._itemDb = itemDb
+    self._tables = {}  # patch -> (flags, first component, # of components, components)
+
+  def _get_table(self, itemDb):
+    # Dense int arrays indexed by item id, components in one array
+    if itemDb.patch not in self._tables:
+      iids = itemDb.get_item_ids()
+      size = max(iids) + 1 if iids else 1
+      flags = np.zeros(size, dtype=np.int64)
+      starts = np.zeros(size, dtype=np.int64)
+      counts = np.zeros(size, dtype=np.int64)
+      components = []
+      for iid in iids:
+        flags[iid] = itemDb.get_flags(iid)
+        starts[iid] = len(components)
+        counts[iid] = len(itemDb.get_components(iid))
+        components.extend(itemDb.get_components(iid))
+      self._tables[itemDb.patch] = (flags, starts, counts, np.array(components, dtype=np.int64))
+    return self._tables[itemDb.patch]
+
+  def _get_batch_tables(self, matches):
+    # Tables of the patches the batch was played on, concatenated. An item of match i is at
+    # bases[i] + item id if it is below sizes[i].
+    tables = []
+    table_index = {}  # patch -> index in tables
+    match_tables = []
+    for match in matches:
+      itemDb = self._itemDb.for_version(match.get("matchVersion"))
+      if itemDb.patch not in table_index:
+        table_index[itemDb.patch] = len(tables)
+        tables.append(self._get_table(itemDb))
+      match_tables.append(table_index[itemDb.patch])
+
+    sizes = np.array([len(table[0]) for table in tables], dtype=np.int64)
+    num_components = np.array([len(table[3]) for table in tables], dtype=np.int64)
+    component_bases = np.cumsum(num_components) - num_components
+    match_tables = np.array(match_tables, dtype=np.int64)
+    return (
+      np.concatenate([table[0] for table in tables]),
+      np.concatenate([table[1] + base for table, base in zip(tables, component_bases)]),
+      np.concatenate([table[2] for table in tables]),
+      np.concatenate([table[3] for table in tables]),
+      (np.cumsum(sizes) - sizes)[match_tables],
+      sizes[match_tables],
+    )
+
+  @staticmethod
+  def _lookup(tables, match_idx, iids):
+    # (flags, first component, # of components) of each item, 0 for items missing from the table
+    flags, starts, counts, _, bases, sizes = tables
+    known = (iids >= 0) & (iids < sizes[match_idx])
+    index = bases[match_idx] + np.where(known, iids, 0)
+    return np.where(known, flags[index], 0), starts[index], np.where(known, counts[index], 0)
+
+  ###
+  # Flattening
+  #
+  ###
+
+  def _init_builds(self, match):
+    # Same skeleton as MatchProcessor.get_builds_from_match
+    builds = {}
+    for p in match["participants"]:
+      p["runes"].sort(key=operator.itemgetter("runeId"))
+      p["masteries"].sort(key=operator.itemgetter("masteryId"))
+      builds[p["participantId"]] = {
+        "stats": p["stats"],
+        "build": {
+          "championId": p["championId"],
+          "lane": p["timeline"]["lane"],
+          "role": p["timeline"]["role"],
+          "skillups": [],
+          "summonerSpells": [p["spell1Id"], p["spell2Id"]],
+          "runes": p["runes"],
+          "masteries": p["masteries"],
+          "itemEvents": [],
+          "finalBuild": [],
+        }
+      }
+    return builds
+
+  @staticmethod
+  def _int_column(values):
+    # Ints, or digit strings like the zero padded item ids of matches that were processed before,
+    # which are parsed a digit position at a time
+    column = np.array(values)
+    if column.dtype.kind not in "SU" or len(column) == 0:
+      return column.astype(np.int64)
+    chars = column.view(np.uint8 if column.dtype.kind == "S" else np.uint32).reshape(len(column), -1)
+    digits = chars.astype(np.int64) - ord("0")
+    is_digit = (digits >= 0) & (digits <= 9)
+    is_padding = chars == 0  # strings shorter than the column are padded at the end
+    if not (is_digit | is_padding).all() or not is_digit[:, 0].all() or (is_padding[:, :-1] & is_digit[:, 1:]).any():
+      return np.array([int(value) for value in values], dtype=np.int64)
+    ints = np.zeros(len(column), dtype=np.int64)
+    for position in xrange(chars.shape[1]):
+      ints = np.where(is_digit[:, position], ints * 10 + digits[:, position], ints)
+    return ints
+
+  @staticmethod
+  def _str_column(column, fn):
+    # fn of each value as an object array, called once per distinct value
+    values, inverse = np.unique(column, return_inverse=True)
+    return np.array([fn(value) for value in values.tolist()], dtype=object)[inverse]
+
+  def _flatten(self, matches):
+    # Item and skill events as columns in processing order, i.e latest event first like
+    # MatchProcessor. Returns the item events themselves too, for the fields only the purchases
+    # that end up in builds need. Events of participants other than 1-10 are left out.
+    events = []
+    num_events = []
+    for match in matches:
+      match_events = [event for frame in reversed(match["timeline"]["frames"]) if "events" in frame
+        for event in reversed(frame["events"]) if event["eventType"] in BatchMatchProcessor._EVENT_CODES]
+      events.extend(match_events)
+      num_events.append(len(match_events))
+    codes = np.array(map(BatchMatchProcessor._EVENT_CODES.__getitem__, map(operator.itemgetter("eventType"), events)),
+      dtype=np.int8)
+    pids = self._int_column([event.get("participantId", 0) for event in events])
+    groups = np.repeat(np.arange(len(matches), dtype=np.int64) * BatchMatchProcessor._MAX_PARTICIPANTS, num_events) + pids
+    is_valid = (pids >= 1) & (pids <= 10)
+
+    rows = np.flatnonzero(is_valid & (codes != BatchMatchProcessor._SKILL))
+    items = [events[i] for i in rows.tolist()]
+    item_columns = (groups[rows], codes[rows], self._int_column([event.get("itemId", 0) for event in items]))
+
+    rows = np.flatnonzero(is_valid & (codes == BatchMatchProcessor._SKILL))
+    skills = [events[i] for i in rows.tolist()]
+    is_normal = np.array([event["levelUpType"] == u"NORMAL" for event in skills], dtype=bool)
+    skill_columns = (groups[rows][is_normal], self._int_column([event["skillSlot"] for event in skills])[is_normal])
+    return items, item_columns, skill_columns
+
+  ###
+  # Array operations
+  #
+  ###
+
+  @staticmethod
+  def _segment_starts(*keys):
+    # Bool mask of where each run of equal keys begins, keys must be grouped
+    starts = np.ones(len(keys[0]), dtype=bool)
+    if len(keys[0]) > 1:
+      starts[1:] = False
+      for key in keys:
+        starts[1:] |= key[1:] != key[:-1]
+    return starts
+
+  @staticmethod
+  def _counter_before(steps, starts):
+    # For a counter per segment that starts at 0, goes up by one for +1 steps, and down by one
+    # for -1 steps unless it is already 0 (which is how undos and sold items cancel later
+    # purchases), returns the counter value before each step.
+    # Floored walk: c_k = S_k - min(0, min_{j<=k} S_j) with S the running sum within the segment.
+    n = len(steps)
+    if n == 0:
+      return np.zeros(0, dtype=np.int64)
+    segment = np.cumsum(starts) - 1
+    running = np.cumsum(steps)
+    start_idx = np.flatnonzero(starts)
+    offset = running[start_idx] - steps[start_idx]
+    local = running - offset[segment]
+
+    # Shift each segment below all previous ones so a global running min stays within segments
+    spread = 2 * n + 1
+    shifted = local - spread * segment
+    local_min = np.minimum.accumulate(shifted) + spread * segment
+    after = local - np.minimum(local_min, 0)
+
+    before = np.empty(n, dtype=np.int64)
+    before[1:] = after[:-1]
+    before[starts] = 0
+    return before
+
+  @staticmethod
+  def _group_slices(groups):
+    # (group, start, end) of each run of a sorted group column
+    starts = np.flatnonzero(BatchMatchProcessor._segment_starts(groups))
+    ends = np.append(starts[1:], len(groups))
+    return zip(groups[starts].tolist(), starts.tolist(), ends.tolist())
+
+  def _resolve_purchases(self, tables, groups, codes, iids):
+    # Returns the indexes of the purchases that end up in builds, in processing order, and their
+    # flags
+    events = np.argsort(groups, kind="mergesort")  # by participant, then in processing order
+    groups, codes, iids = groups[events], codes[events], iids[events]
+
+    # 1. Undos cancel the next sell or purchase (going backwards in time)
+    steps = np.where(codes == BatchMatchProcessor._UNDO, 1, -1)
+    undone = BatchMatchProcessor._counter_before(steps, BatchMatchProcessor._segment_starts(groups)) > 0
+    live = (codes != BatchMatchProcessor._UNDO) & ~undone
+    events, groups, codes, iids = events[live], groups[live], codes[live], iids[live]
+
+    match_idx = groups // BatchMatchProcessor._MAX_PARTICIPANTS
+    flags, component_starts, component_counts = self._lookup(tables, match_idx, iids)
+    is_sold = codes == BatchMatchProcessor._SOLD
+
+    # 2. Sold final items, and final components of sold upgrades, cancel one earlier purchase each
+    upgrade_sold = np.flatnonzero(is_sold & ((flags & RiotItems.UPGRADED) != 0))
+    counts = component_counts[upgrade_sold]
+    component_events = np.repeat(upgrade_sold, counts)
+    within = np.arange(len(component_events)) - np.repeat(np.cumsum(counts) - counts, counts)
+    component_iids = tables[3][component_starts[component_events] + within]
+    component_flags = self._lookup(tables, match_idx[component_events], component_iids)[0]
+    is_final_component = (component_flags & RiotItems.FINAL) != 0
+    component_events = component_events[is_final_component]
+    component_iids = component_iids[is_final_component]
+
+    item_sold = np.flatnonzero(is_sold & ((flags & RiotItems.FINAL) != 0))
+    purchases = np.flatnonzero(codes == BatchMatchProcessor._PURCHASED)
+
+    # Tokens (+1) and purchase attempts (-1) per participant and item id, in processing order
+    entry_events = np.concatenate([component_events, item_sold, purchases])
+    entry_iids = np.concatenate([component_iids, iids[item_sold], iids[purchases]])
+    entry_steps = np.concatenate([
+      np.ones(len(component_events) + len(item_sold), dtype=np.int64),
+      -np.ones(len(purchases), dtype=np.int64),
+    ])
+    entry_groups = groups[entry_events]
+    order = np.lexsort((entry_events, entry_iids, entry_groups))
+    starts = BatchMatchProcessor._segment_starts(entry_groups[order], entry_iids[order])
+    removed = BatchMatchProcessor._counter_before(entry_steps[order], starts) > 0
+    kept = entry_events[order][(entry_steps[order] < 0) & ~removed]
+
+    order = np.argsort(events[kept])
+    return events[kept][order], flags[kept][order]
+
+  ###
+  # Public Methods
+  #
+  ###
+
+  def get_builds_from_matches(self, matches):
+    # Returns one list of participants per match, same as MatchProcessor.get_builds_from_match
+    if not matches:
+      return []
+    all_builds = [self._init_builds(match) for match in matches]
+    build_by_group = {}
+    for mi, builds in enumerate(all_builds):
+      for pid, participant in builds.iteritems():
+        build_by_group[mi * BatchMatchProcessor._MAX_PARTICIPANTS + pid] = participant["build"]
+    items, (groups, codes, iids), (skill_groups, skill_slots) = self._flatten(matches)
+
+    # Skill orders, reversed from processing order to get chronological order
+    skill_groups, skill_slots = skill_groups[::-1], skill_slots[::-1]
+    order = np.argsort(skill_groups, kind="mergesort")
+    skill_slots = self._str_column(skill_slots[order], str).tolist()
+    for group, start, end in self._group_slices(skill_groups[order]):
+      build_by_group[group]["skillups"] = skill_slots[start:end]
+
+    # Item events and final builds, chronological like the skill orders
+    kept, flags = self._resolve_purchases(self._get_batch_tables(matches), groups, codes, iids)
+    kept, flags = kept[::-1], flags[::-1]
+    groups = groups[kept]
+    is_final = ((flags & RiotItems.FINAL) != 0) & ((flags & RiotItems.UPGRADED) == 0)
+    item_keys = self._str_column(iids[kept], lambda iid: str(iid).zfill(4))
+
+    rows = np.flatnonzero(is_final)
+    rows = rows[np.argsort(groups[rows], kind="mergesort")]
+    final_keys = item_keys[rows].tolist()
+    for group, start, end in self._group_slices(groups[rows]):
+      build_by_group[group]["finalBuild"] = final_keys[start:end]
+
+    # Like MatchProcessor, purchases keep the is_final_item marker of an earlier run unless they
+    # are final now
+    rows = np.flatnonzero((flags & RiotItems.POTION_OR_TRINKET) == 0)
+    rows = rows[np.argsort(groups[rows], kind="mergesort")]
+    item_events = [
+      {"itemId": key, "timestamp": event["timestamp"], "is_final_item": True} if final else
+        {"itemId": key, "timestamp": event["timestamp"], "is_final_item": event["is_final_item"]}
+        if "is_final_item" in event else
+        {"itemId": key, "timestamp": event["timestamp"]}
+      for key, event, final in itertools.izip(item_keys[rows].tolist(), [items[i] for i in kept[rows].tolist()], is_final[rows].tolist())
+    ]
+    for group, start, end in self._group_slices(groups[rows]):
+      build_by_group[group]["itemEvents"] = item_events[start:end]
+
+    ret = []
+    for match, builds in zip(matches, all_builds):
+      participants = []
+      for pid in builds:
+        build = builds[pid]["build"]
+        participants.append(builds[pid])
+
+        if len(build["finalBuild"]) > 6:
+          print "!! BUILD LEN > 6: %r, %r" % (match["matchId"], build["finalBuild"])
+      ret.append(participants)
+    return ret
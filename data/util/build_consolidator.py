@@ -0,0 +1,202 @@
+import itertools
+from bson import SON
+
+from pymongo import ASCENDING, ReplaceOne
+
+from item_trie import ItemTrie
+
+# Stats that are combined from partial builds, in the order of the consolidated document
+_STATS = [
+  "count",
+  "wins",
+  "losses",
+  "kills",
+  "deaths",
+  "assists",
+  "damageToChampions",
+  "minionsKilled",
+  "goldEarned",
+]
+_DICT_FIELDS = ["skillups", "summonerSpells", "runes", "masteries"]
+_MAX_INDEX = 2 ** 32 - 1
+
+def _is_index(key):
+  # Whether JS treats the key as an array index, those are iterated first in numeric order
+  return key.isdigit() and (key == "0" or key[0] != "0") and int(key) < _MAX_INDEX
+
+def _js_keys(obj):
+  # Keys in JS for-in order, insertion order is only kept if obj is ordered (i.e SON)
+  keys = list(obj)
+  return sorted((k for k in keys if _is_index(k)), key=int) + [k for k in keys if not _is_index(k)]
+
+def _merge_weighted(fromd, intod, weight):
+  for key in fromd:
+    intod[key] = intod.get(key, 0) + float(fromd[key]) / weight
+
+def _find_highest(obj):
+  highest_val = -1
+  highest_key = None
+  for key in _js_keys(obj or {}):
+    if obj[key] > highest_val:
+      highest_val = obj[key]
+      highest_key = key
+  return highest_key
+
+class BuildConsolidator(object):
+  # Single pass replacement of consolidate.py's aggregations and map-reduces. Builds are read
+  # once, ordered by champion/lane/role, and each group is consolidated in memory: builds with
+  # fewer than 6 items are partial builds, and each one is merged into the full builds it is a
+  # prefix of (by _key), weighted by the # of those full builds. Output is the same as the
+  # finalized map-reduce output: most common runes/masteries/skillups/spells and item order.
+  # With a TriePruner, builds are consolidated with their pruned item tries, which are written back.
+  PARTIAL_SIZES = [4, 5, 3, 2]  # order the map-reduce merges applied partial builds in
+  BATCH_SIZE = 500  # documents per insert
+  GROUP_FIELDS = ["championId", "lane", "role"]
+
+  def __init__(self, input_coll, output_coll, batch_size=BATCH_SIZE, pruner=None):
+    self._input = input_coll
+    self._output = output_coll
+    self._batch_size = batch_size
+    self._pruner = pruner
+
+  @staticmethod
+  def _prefix(build, size):
+    # Same as the $substr of _key the aggregation grouped by (item ids are 4 digits)
+    return build["_key"][:5 * size - 1]
+
+  @staticmethod
+  def _item_trie(build, pruner):
+    if pruner is not None:
+      return pruner.prune(build)
+    return ItemTrie.from_document(build["itemEvents"]["neighbors"])
+
+  @staticmethod
+  def _partial_trie(key, partial, tries, pruner):
+    # A partial is merged into every full build it's a prefix of, so its trie is only built once
+    if key not in tries:
+      has_items = partial.get("itemEvents") is not None
+      tries[key] = BuildConsolidator._item_trie(partial, pruner) if has_items else None
+    return tries[key]
+
+  @staticmethod
+  def _consolidate_build(build, partials, weights, tries, pruner):
+    value = SON([
+      ("championId", build["championId"]),
+      ("lane", build["lane"]),
+      ("role", build["role"]),
+    ])
+    for field in _DICT_FIELDS:
+      if field in build:
+        value[field] = SON(build[field])
+    value["itemEvents"] = build["itemEvents"]
+    value["finalBuild"] = build["finalBuild"]
+    value["_key"] = build["_key"]
+    value["stats"] = SON((stat, build["stats"][stat]) for stat in _STATS)
+
+    trie = BuildConsolidator._item_trie(build, pruner)
+    for size in BuildConsolidator.PARTIAL_SIZES:
+      prefix = BuildConsolidator._prefix(build, size)
+      partial = partials.get((size, prefix))
+      if partial is None:
+        continue
+      weight = weights[(size, prefix)]
+      for stat in _STATS:
+        value["stats"][stat] += float(partial["stats"][stat]) / weight
+      for field in _DICT_FIELDS:
+        if field in partial:
+          _merge_weighted(partial[field], value.setdefault(field, SON()), weight)
+      partial_trie = BuildConsolidator._partial_trie((size, prefix), partial, tries, pruner)
+      if partial_trie is not None:
+        trie.merge(partial_trie)
+
+    # Pick the most common of everything
+    value["skillups"] = _find_highest(value.get("skillups"))
+    spells = value.get("summonerSpells", SON())
+    highest = _find_highest(spells)
+    spells.pop(highest, None)
+    value["summonerSpells"] = [highest, _find_highest(spells)]
+    value["runes"] = _find_highest(value["runes"])
+    value["masteries"] = _find_highest(value["masteries"])
+    value["itemEvents"] = trie.find_path(6)
+    return value
+
+  @staticmethod
+  def consolidate_group(builds, pruner=None):
+    # Consolidated documents of one champion/lane/role's builds, full builds without
+    # a complete item path are dropped
+    partials = {}  # (size, _key prefix) -> partial build
+    weights = {}  # (size, _key prefix) -> # of full builds with that prefix
+    full_builds = []
+    for build in builds:
+      size = len(build["finalBuild"])
+      if size == 6:
+        full_builds.append(build)
+        for partial_size in BuildConsolidator.PARTIAL_SIZES:
+          key = (partial_size, BuildConsolidator._prefix(build, partial_size))
+          weights[key] = weights.get(key, 0) + 1
+      elif size in BuildConsolidator.PARTIAL_SIZES:
+        partials.setdefault((size, BuildConsolidator._prefix(build, size)), build)
+
+    tries = {}  # (size, _key prefix) -> partial build's ItemTrie
+    docs = []
+    for build in full_builds:
+      value = BuildConsolidator._consolidate_build(build, partials, weights, tries, pruner)
+      if value["itemEvents"] is not None:
+        docs.append(SON([("_id", build["_id"]), ("value", value)]))
+    return docs
+
+  def _read_groups(self, query):
+    # Index on championId, lane, role (see BuildDb) keeps this from sorting in memory
+    sort = [(field, ASCENDING) for field in BuildConsolidator.GROUP_FIELDS]
+    cursor = self._input.find(query or {}, no_cursor_timeout=True).sort(sort)
+    try:
+      for key, builds in itertools.groupby(cursor, lambda b: tuple(b[f] for f in BuildConsolidator.GROUP_FIELDS)):
+        yield key, builds
+    finally:
+      cursor.close()
+
+  def _insert(self, docs):
+    if docs:
+      self._output.insert_many(docs, ordered=False)
+
+  def _replace_group(self, group, docs):
+    # Swaps in a group's new documents, without a window where the group is missing
+    if docs:
+      self._output.bulk_write([ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in docs], ordered=False)
+    query = dict(("value." + field, value) for field, value in zip(BuildConsolidator.GROUP_FIELDS, group))
+    query["_id"] = {"$nin": [doc["_id"] for doc in docs]}
+    self._output.delete_many(query)
+
+  def _flush_pruner(self):
+    if self._pruner is not None:
+      self._pruner.flush()
+
+  def run_groups(self, groups):
+    # Reconsolidates only the given (championId, lane, role) groups, replacing their documents in
+    # the output collection. Returns the # of consolidated builds.
+    num_docs = 0
+    for group in groups:
+      builds = self._input.find(dict(zip(BuildConsolidator.GROUP_FIELDS, group)))
+      docs = BuildConsolidator.consolidate_group(builds, self._pruner)
+      self._replace_group(group, docs)
+      num_docs += len(docs)
+    self._flush_pruner()
+    return num_docs
+
+  def run(self, query=None):
+    # Consolidates the builds matching query into the output collection, returns
+    # (# of groups, # of consolidated builds)
+    num_groups = 0
+    num_docs = 0
+    batch = []
+    for key, builds in self._read_groups(query):
+      docs = BuildConsolidator.consolidate_group(builds, self._pruner)
+      num_groups += 1
+      num_docs += len(docs)
+      batch.extend(docs)
+      if len(batch) >= self._batch_size:
+        self._insert(batch)
+        batch = []
+    self._insert(batch)
+    self._flush_pruner()
+    return num_groups, num_docs
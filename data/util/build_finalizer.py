@@ -0,0 +1,119 @@
+import itertools
+import numpy as np
+from bson import SON
+
+from pymongo import ASCENDING
+
+class BuildFinalizer(object):
+  # Single pass replacement of finalize.py's map-reduces. Every pass groups by champion first, so
+  # each champion's consolidated builds are read once and finalized in memory:
+  #   1. builds with the same items in any order are grouped (order deltas)
+  #   2. then, for each of the 6 item slots, builds that only differ in that slot (item deltas)
+  #   3. the most played of what's left is the common build, the rest with a winrate at most 5%
+  #      lower are its outliers
+  # Each grouping keeps the best build (most played, then highest winrate, first on ties) with the
+  # group's playrate and the others as deltas. Groups are handed to the next pass ordered by key,
+  # which is the order the map-reduce wrote and then read them in.
+  BATCH_SIZE = 100  # champions per insert
+  WINRATE_RANGE = .05
+  NUM_ITEMS = 6
+
+  def __init__(self, input_coll, output_coll, batch_size=BATCH_SIZE):
+    self._input = input_coll
+    self._output = output_coll
+    self._batch_size = batch_size
+
+  @staticmethod
+  def _order_key(value):
+    return (value["championId"], value["role"], value["lane"], ",".join(sorted(value["finalBuild"])))
+
+  @staticmethod
+  def _item_key_fn(index):
+    def item_key(value):
+      items = list(value["finalBuild"])
+      items[index] = "----"
+      return (value["championId"], value["role"], value["lane"], ",".join(items))
+    return item_key
+
+  @staticmethod
+  def _winrate(value):
+    return float(value["stats"]["wins"]) / value["stats"]["count"]
+
+  @staticmethod
+  def _group(values, key_fn):
+    # DELTA_REDUCE_FN over values grouped by key_fn, returns the best build of each group in key order
+    codes = {}  # key -> group #
+    members = []  # group # -> indexes in values, in order
+    groups = np.empty(len(values), dtype=np.int64)
+    for i, value in enumerate(values):
+      group = codes.setdefault(key_fn(value), len(codes))
+      if group == len(members):
+        members.append([])
+      members[group].append(i)
+      groups[i] = group
+
+    counts = np.array([value["stats"]["count"] for value in values], dtype=np.float64)
+    wins = np.array([value["stats"]["wins"] for value in values], dtype=np.float64)
+    # Sorted by group, then most played, then highest winrate, then first, so each group's best
+    # build comes first
+    order = np.lexsort((np.arange(len(values)), -(wins / counts), -counts, groups))
+    is_first = np.ones(len(order), dtype=bool)
+    is_first[1:] = groups[order[1:]] != groups[order[:-1]]
+    best = dict(zip(groups[order[is_first]].tolist(), order[is_first].tolist()))
+
+    results = []
+    for key, group in sorted(codes.iteritems()):
+      highest = values[best[group]]
+      deltas = [values[i] for i in members[group] if i != best[group]]
+      value = SON(highest)
+      value["playrate"] = highest["stats"]["count"]
+      for delta in deltas:
+        value["playrate"] += delta["stats"]["count"]
+      # DELTA_REDUCE_FN filters deltas by winrate, but then overwrites them with all of them
+      value["deltas"] = [SON([
+        ("finalBuild", delta["finalBuild"]),
+        ("wins", delta["stats"]["wins"]),
+        ("count", delta["stats"]["count"]),
+      ]) for delta in deltas]
+      results.append(value)
+    return results
+
+  @staticmethod
+  def finalize_champion(values):
+    # values are one champion's consolidated builds, in the order the map-reduce read them.
+    # Returns {common, outliers}
+    builds = BuildFinalizer._group(values, BuildFinalizer._order_key)
+    for index in xrange(BuildFinalizer.NUM_ITEMS):
+      builds = BuildFinalizer._group(builds, BuildFinalizer._item_key_fn(index))
+
+    builds = sorted(builds, key=lambda build: -build["playrate"])
+    common = builds[0]
+    winrate = BuildFinalizer._winrate(common)
+    outliers = [b for b in builds[1:] if winrate - BuildFinalizer._winrate(b) <= BuildFinalizer.WINRATE_RANGE]
+    outliers.sort(key=lambda build: -(build["playrate"] * BuildFinalizer._winrate(build)))
+    return SON([("common", common), ("outliers", outliers)])
+
+  def _insert(self, docs):
+    if docs:
+      self._output.insert_many(docs, ordered=False)
+
+  def run(self, query=None):
+    # Finalizes the consolidated builds matching query into the output collection, returns
+    # (# of champions, # of builds read)
+    cursor = self._input.find(query or {}, no_cursor_timeout=True).sort("value.championId", ASCENDING)
+    num_champions = 0
+    num_builds = 0
+    batch = []
+    try:
+      for champion_id, docs in itertools.groupby(cursor, lambda doc: doc["value"]["championId"]):
+        values = [doc["value"] for doc in docs]
+        batch.append(SON([("_id", champion_id), ("value", BuildFinalizer.finalize_champion(values))]))
+        num_champions += 1
+        num_builds += len(values)
+        if len(batch) >= self._batch_size:
+          self._insert(batch)
+          batch = []
+    finally:
+      cursor.close()
+    self._insert(batch)
+    return num_champions, num_builds
@@ -0,0 +1,196 @@
+from array import array
+from bson import SON
+
+class ItemTrie(object):
+  # Item purchase orders of a build, stored as parallel arrays indexed by node (node 0 is the root)
+  # instead of nested itemEvents.neighbors.<itemId> documents. Children are kept as linked lists
+  # (first child, next sibling) in creation order. Converts from and to the document shape
+  # BuildDb writes: {itemId: {itemId, count, wins, timestamp, is_final_item, neighbors}}.
+  __slots__ = ["_item_ids", "_counts", "_wins", "_timestamps", "_flags", "_first_child",
+    "_next_sibling"]
+
+  # Node flags. BuildDb only sets itemId and is_final_item on a build's first insert, so nodes
+  # added to the trie by later builds of the same _key have neither.
+  FINAL_ITEM = 1
+  HAS_ITEM_ID = 2
+
+  # Item id of the branch prune() folds rare items into, keyed "other" in documents
+  OTHER = -1
+  OTHER_KEY = "other"
+
+  def __init__(self):
+    self._item_ids = array("l", [0])
+    self._counts = array("l", [0])
+    self._wins = array("l", [0])
+    self._timestamps = array("d", [0])  # sums, divided by count for the average
+    self._flags = bytearray(1)
+    self._first_child = array("l", [-1])
+    self._next_sibling = array("l", [-1])
+
+  def __len__(self):
+    # Number of item nodes
+    return len(self._item_ids) - 1
+
+  def _add_node(self, parent, item_id, flags):
+    node = len(self._item_ids)
+    self._item_ids.append(item_id)
+    self._counts.append(0)
+    self._wins.append(0)
+    self._timestamps.append(0)
+    self._flags.append(flags)
+    self._first_child.append(-1)
+    self._next_sibling.append(-1)
+
+    child = self._first_child[parent]
+    if child == -1:
+      self._first_child[parent] = node
+    else:
+      while self._next_sibling[child] != -1:
+        child = self._next_sibling[child]
+      self._next_sibling[child] = node
+    return node
+
+  def _child(self, parent, item_id, flags):
+    # Child of parent for item_id, created if there is none
+    child = self._first_child[parent]
+    while child != -1:
+      if self._item_ids[child] == item_id:
+        return child
+      child = self._next_sibling[child]
+    return self._add_node(parent, item_id, flags)
+
+  def _children(self, node):
+    children = []
+    child = self._first_child[node]
+    while child != -1:
+      children.append(child)
+      child = self._next_sibling[child]
+    return children
+
+  def add_path(self, item_events, won, count=1):
+    # item_events as in a build: [{itemId, timestamp, is_final_item}], like one build of BuildDb.insert_builds
+    node = 0
+    for event in item_events:
+      flags = ItemTrie.HAS_ITEM_ID | (ItemTrie.FINAL_ITEM if event.get("is_final_item") else 0)
+      node = self._child(node, int(event["itemId"]), flags)
+      self._counts[node] += count
+      self._wins[node] += count if won else 0
+      self._timestamps[node] += event["timestamp"]
+
+  def merge(self, other):
+    # Adds other's counts into this trie, other is left as is
+    stack = [(0, 0)]  # (node in other, node in self)
+    while stack:
+      other_node, node = stack.pop()
+      child = other._first_child[other_node]
+      while child != -1:
+        into = self._child(node, other._item_ids[child], other._flags[child])
+        self._add_counts(into, other, child)
+        stack.append((child, into))
+        child = other._next_sibling[child]
+
+  @staticmethod
+  def from_document(neighbors):
+    # neighbors is a build's itemEvents.neighbors, read as SON to keep the order of items
+    trie = ItemTrie()
+    stack = [(0, neighbors)]
+    while stack:
+      parent, children = stack.pop()
+      for item_id, doc in children.iteritems():
+        flags = (ItemTrie.FINAL_ITEM if doc.get("is_final_item") else 0) | (ItemTrie.HAS_ITEM_ID if "itemId" in doc else 0)
+        node = trie._add_node(parent, ItemTrie.OTHER if item_id == ItemTrie.OTHER_KEY else int(item_id), flags)
+        trie._counts[node] = int(doc["count"])
+        trie._wins[node] = int(doc["wins"])
+        trie._timestamps[node] = doc["timestamp"]
+        if doc.get("neighbors") is not None:
+          stack.append((node, doc["neighbors"]))
+    return trie
+
+  def _item_key(self, node):
+    item_id = self._item_ids[node]
+    return ItemTrie.OTHER_KEY if item_id == ItemTrie.OTHER else str(item_id).zfill(4)
+
+  def _node_document(self, node):
+    timestamp = self._timestamps[node]
+    doc = SON()
+    if self._flags[node] & ItemTrie.HAS_ITEM_ID:
+      doc["itemId"] = self._item_key(node)
+    doc["count"] = self._counts[node]
+    doc["wins"] = self._wins[node]
+    doc["timestamp"] = int(timestamp) if timestamp.is_integer() else timestamp
+    if self._flags[node] & ItemTrie.FINAL_ITEM:
+      doc["is_final_item"] = True
+    return doc
+
+  def to_document(self, node=0):
+    # Inverse of from_document
+    neighbors = SON()
+    for child in self._children(node):
+      doc = self._node_document(child)
+      if self._first_child[child] != -1:
+        doc["neighbors"] = self.to_document(child)
+      neighbors[self._item_key(child)] = doc
+    return neighbors
+
+  def _js_order(self, children):
+    # Order JS iterates the children's keys in: array index like item ids ascending, then the
+    # rest (zero padded ids) in creation order
+    indexes = sorted((c for c in children if self._item_ids[c] >= 1000), key=lambda c: self._item_ids[c])
+    return indexes + [c for c in children if self._item_ids[c] < 1000]  # incl. OTHER
+
+  def _sorted_children(self, node):
+    # By count, most first. Ties come out in reverse JS key order, as consolidate.py's JS
+    # comparator (which never orders equal counts) did under mongod's sort.
+    children = list(reversed(self._js_order(self._children(node))))
+    return sorted(children, key=lambda child: -self._counts[child])
+
+  def _path_node(self, node):
+    # itemId comes from the key, so nodes without one still get it
+    return SON([
+      ("is_final_item", True if self._flags[node] & ItemTrie.FINAL_ITEM else None),
+      ("itemId", self._item_key(node)),
+      ("timestamp", self._timestamps[node] / self._counts[node]),
+    ])
+
+  def find_path(self, final_items=6, node=0):
+    # Most common item order that has all the final items, None if there is none. Same as
+    # find_path in consolidate.py's FINALIZE_MAP_FN, final_items isn't reset between siblings.
+    for child in self._sorted_children(node):
+      if self._item_ids[child] == ItemTrie.OTHER:
+        continue
+      if self._flags[child] & ItemTrie.FINAL_ITEM:
+        final_items -= 1
+      if self._first_child[child] != -1:
+        path = self.find_path(final_items, child)
+        if path:
+          path.insert(0, self._path_node(child))
+          return path
+      else:
+        return None if final_items > 0 else [self._path_node(child)]
+    return None
+
+  def _add_counts(self, node, other, other_node):
+    self._counts[node] += other._counts[other_node]
+    self._wins[node] += other._wins[other_node]
+    self._timestamps[node] += other._timestamps[other_node]
+
+  def pruned(self, max_depth=None, min_count=0):
+    # Copy without the nodes deeper than max_depth, and with the branches bought fewer than
+    # min_count times folded into an OTHER node of their parent (its subtree is dropped). The most
+    # common item at each node is always kept, so a build's own path doesn't get folded away.
+    trie = ItemTrie()
+    stack = [(0, 0, 0)]  # (node, copy in trie, depth)
+    while stack:
+      node, copy, depth = stack.pop()
+      if max_depth is not None and depth >= max_depth:
+        continue
+      top = next((c for c in self._sorted_children(node) if self._item_ids[c] != ItemTrie.OTHER), None)
+      for child in self._children(node):
+        item_id = self._item_ids[child]
+        if item_id != ItemTrie.OTHER and (child == top or self._counts[child] >= min_count):
+          child_copy = trie._add_node(copy, item_id, self._flags[child])
+          stack.append((child, child_copy, depth + 1))
+        else:
+          child_copy = trie._child(copy, ItemTrie.OTHER, 0)
+        trie._add_counts(child_copy, self, child)
+    return trie
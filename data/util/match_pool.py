@@ -0,0 +1,67 @@
+import json
+import signal
+from concurrent.futures import ProcessPoolExecutor
+
+from riot_api import RiotItems
+from .match_processor import MatchProcessor
+
+# Stats BuildDb.insert_builds uses, the rest is dropped from build records
+_BUILD_STATS = [
+  "winner",
+  "kills",
+  "deaths",
+  "assists",
+  "totalDamageDealtToChampions",
+  "minionsKilled",
+  "goldEarned",
+]
+
+def process_match(match_processor, match):
+  # Everything the collector needs from a match: players to queue, compact build records of
+  # participants with at least 2 final items, and the processed match to store
+  participants = []
+  for p in match_processor.get_builds_from_match(match):
+    if len(p["build"]["finalBuild"]) < 2:
+      continue
+    p["stats"] = dict((stat, p["stats"][stat]) for stat in _BUILD_STATS)
+    participants.append(p)
+  return {
+    "players": [p["player"] for p in match["participantIdentities"]],
+    "leagues": [p["highestAchievedSeasonTier"] for p in match["participants"]],
+    "participants": participants,
+    "match": match,
+  }
+
+# Per process MatchProcessor, created on the first match a pool process gets
+_match_processor = None
+
+def _process_raw_match(patch, body):
+  global _match_processor
+  if _match_processor is None:
+    _match_processor = MatchProcessor(RiotItems(patch))
+  return process_match(_match_processor, json.loads(body))
+
+def _warm_up():
+  pass
+
+class MatchProcessorPool(object):
+  # Parses and processes raw match responses in other processes, each with its own RiotItems,
+  # so processing isn't limited by the GIL of the threads waiting on the API and the db
+
+  def __init__(self, patch, size):
+    self._patch = patch
+    # Processes are forked on the first submit, do it now before any other threads are started.
+    # They ignore SIGINT, the collector shuts them down when it stops.
+    handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+      self._executor = ProcessPoolExecutor(max_workers=size)
+      self._executor.submit(_warm_up).result()
+    finally:
+      signal.signal(signal.SIGINT, handler)
+
+  def process(self, body):
+    # Returns a future of process_match's result for the raw match json
+    return self._executor.submit(_process_raw_match, self._patch, body)
+
+  def shutdown(self):
+    self._executor.shutdown(wait=True)
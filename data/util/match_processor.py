@@ -1,3 +1,4 @@
+from riot_api import RiotItems
 
 class MatchProcessor(object):
 
@@ -22,33 +23,26 @@ class MatchProcessor(object):
 
     return cmatch
 
-  def _is_item_final(self, iid):
-    return self._itemDb.is_final_item(iid)
+  # Item ids are ints below, only the ids that end up in builds are zero-padded strings
 
-  def _is_item_upgrade(self, iid):
-    return self._itemDb.is_upgraded_item(iid)
-
-  def _update_items_removed(self, iid, pid, items_removed):
-    if self._is_item_final(iid):
+  def _update_items_removed(self, itemDb, iid, pid, items_removed):
+    if itemDb.get_flags(iid) & RiotItems.FINAL:
       removed = items_removed[pid]
       if iid in removed:
         removed[iid] += 1
       else:
         removed[iid] = 1
 
-  def _register_item_upgrade_sold(self, iid, pid, items_sold):
-    item = self._itemDb.get_item(iid)
-    if item and "from" in item:
-      for base_iid in item["from"]:
-        self._update_items_removed(base_iid, pid, items_sold)
+  def _register_item_upgrade_sold(self, itemDb, iid, pid, items_sold):
+    for base_iid in itemDb.get_components(iid):
+      self._update_items_removed(itemDb, base_iid, pid, items_sold)
 
-  def _process_item_purchase(self, iid, pid, items_removed):
-    if self._is_item_final(iid) and not self._is_item_upgrade(iid):
-      return iid
-    else:
-      return None
+  def _is_final_purchase(self, flags):
+    return (flags & RiotItems.FINAL) and not (flags & RiotItems.UPGRADED)
 
   def get_builds_from_match(self, match):
+    # Classify items as they were on the patch the match was played on
+    itemDb = self._itemDb.for_version(match.get("matchVersion"))
     builds = {}
     items_removed = {}
     items_upgraded = {}
@@ -102,25 +96,25 @@ class MatchProcessor(object):
             items_undone[pid] -= 1
             continue
 
-          iid = event["itemId"]
-          if self._is_item_upgrade(iid):  # in case they sold an upgrade
-            self._register_item_upgrade_sold(iid, pid, items_removed)
-          self._update_items_removed(iid, pid, items_removed)
+          iid = int(event["itemId"])
+          if itemDb.get_flags(iid) & RiotItems.UPGRADED:  # in case they sold an upgrade
+            self._register_item_upgrade_sold(itemDb, iid, pid, items_removed)
+          self._update_items_removed(itemDb, iid, pid, items_removed)
         elif eventType == "ITEM_PURCHASED":
           if items_undone[pid] > 0:
             items_undone[pid] -= 1
             continue
 
-          iid = event["itemId"]
+          iid = int(event["itemId"])
           removed = items_removed[pid]
           if iid in removed and removed[iid] > 0:
             removed[iid] -= 1
             continue
 
-          item = self._process_item_purchase(iid, pid, items_removed)
-          if item is not None:
+          flags = itemDb.get_flags(iid)
+          if self._is_final_purchase(flags):
             event["is_final_item"] = True
-            build["finalBuild"].append(item)
+            build["finalBuild"].append(event["itemId"])
 
           # Append event if not undone or removed (sold)
           trimmed_event = {
@@ -128,7 +122,7 @@ class MatchProcessor(object):
               "timestamp": event["timestamp"]
           }
           if "is_final_item" in event: trimmed_event["is_final_item"] = event["is_final_item"]
-          if not self._itemDb.is_potion_or_trinket(iid):
+          if not flags & RiotItems.POTION_OR_TRINKET:
             build["itemEvents"].append(trimmed_event)
         elif eventType == "ITEM_UNDO":
           items_undone[pid] += 1
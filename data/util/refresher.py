@@ -0,0 +1,81 @@
+import threading
+import time
+
+class Refresher(object):
+  # Runs refresh_fn (consolidation + finalization) in the background every interval seconds,
+  # or sooner once count_fn has gone up by match_threshold since the last refresh
+  INTERVAL = 6 * 60 * 60  # seconds
+  MATCH_THRESHOLD = 50000
+  _CHECK_INTERVAL = 5  # seconds
+
+  def __init__(self, refresh_fn, count_fn, **kwargs):
+    self._refresh_fn = refresh_fn
+    self._count_fn = count_fn
+    self._interval = kwargs.pop("interval", Refresher.INTERVAL)
+    self._match_threshold = kwargs.pop("match_threshold", Refresher.MATCH_THRESHOLD)
+
+    self._lock = threading.Lock()
+    self._last_refresh = time.time()  # guarded by lock, as is the rest of the status
+    self._last_count = count_fn()
+    self._last_duration = None
+    self._last_error = None
+    self._num_refreshes = 0
+    self._is_refreshing = False
+
+    self._is_running = False
+    self._stop_event = threading.Event()
+    self._thread = threading.Thread(target=self._run, name="REFRESHER")
+
+  def _is_due(self):
+    if self._interval > 0 and time.time() - self._last_refresh >= self._interval:
+      return True
+    return self._match_threshold > 0 and self._count_fn() - self._last_count >= self._match_threshold
+
+  def refresh(self):
+    count = self._count_fn()
+    start = time.time()
+    with self._lock:
+      self._is_refreshing = True
+    print "[REFRESHER] Refreshing builds (%d new matches)" % (count - self._last_count)
+    error = None
+    try:
+      self._refresh_fn()
+    except Exception as e:
+      print "!! [REFRESHER] Exception while refreshing: %r" % e
+      error = repr(e)
+    with self._lock:
+      self._is_refreshing = False
+      self._last_refresh = time.time()
+      self._last_duration = self._last_refresh - start
+      self._last_error = error
+      if error is None:
+        self._last_count = count
+        self._num_refreshes += 1
+    print "[REFRESHER] Done in %.1fs" % self._last_duration
+
+  def get_status(self):
+    with self._lock:
+      return {
+        "refreshing": self._is_refreshing,
+        "refreshes": self._num_refreshes,
+        "last_refresh": self._last_refresh,
+        "last_duration": self._last_duration,
+        "last_error": self._last_error,
+        "matches_since": self._count_fn() - self._last_count,
+      }
+
+  def _run(self):
+    while self._is_running:
+      self._stop_event.wait(Refresher._CHECK_INTERVAL)
+      if self._is_running and self._is_due():
+        self.refresh()
+
+  def start(self):
+    self._is_running = True
+    self._thread.start()
+
+  def stop(self):
+    # Waits for a refresh in progress to finish
+    self._is_running = False
+    self._stop_event.set()
+    self._thread.join()
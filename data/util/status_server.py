@@ -0,0 +1,47 @@
+import json
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+class StatusServer(object):
+  # Serves status_fn() as JSON on /status, and /health answers 200 while status_fn()["healthy"]
+  # is true and 503 otherwise, for a process supervisor or load balancer to poll
+  def __init__(self, port, status_fn, host="127.0.0.1"):
+    self._status_fn = status_fn
+
+    server = self
+    class Handler(BaseHTTPRequestHandler):
+      def do_GET(self):
+        server._handle(self)
+
+      def log_message(self, format, *args):
+        pass
+
+    self._httpd = HTTPServer((host, port), Handler)
+    self._httpd.daemon_threads = True
+    self._thread = threading.Thread(target=self._httpd.serve_forever, name="STATUS_SERVER")
+
+  def _handle(self, handler):
+    path = handler.path.split("?")[0]
+    if path not in ("/status", "/health"):
+      handler.send_error(404)
+      return
+    try:
+      status = self._status_fn()
+      code = 200 if path == "/status" or status.get("healthy") else 503
+    except Exception as e:
+      status = {"healthy": False, "error": repr(e)}
+      code = 500
+    body = json.dumps(status, indent=2, sort_keys=True)
+    handler.send_response(code)
+    handler.send_header("Content-Type", "application/json")
+    handler.send_header("Content-Length", str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+  def start(self):
+    self._thread.start()
+
+  def stop(self):
+    self._httpd.shutdown()
+    self._thread.join()
+    self._httpd.server_close()
@@ -0,0 +1,58 @@
+from pymongo import UpdateOne
+
+from metrics import Metrics
+from .item_trie import ItemTrie
+
+class TriePruner(object):
+  # Caps the size of build documents by pruning their item tries (see ItemTrie.pruned) and writing
+  # the pruned tries back. A write only applies if the build's stats.count is still the one that
+  # was read, so builds inserted to in the meantime are left for the next run instead of losing
+  # their increments. Runs as its own pass (run) or on the builds consolidation reads anyway.
+  # Read builds as SON, so the order of items in the written tries stays the same.
+  MAX_DEPTH = 30  # items, a game rarely has more purchases that aren't potions or trinkets
+  MIN_COUNT = 2
+  BATCH_SIZE = 500  # writes per bulk write
+
+  def __init__(self, build_coll, max_depth=MAX_DEPTH, min_count=MIN_COUNT, batch_size=BATCH_SIZE):
+    self._builds = build_coll
+    self._max_depth = max_depth
+    self._min_count = min_count
+    self._batch_size = batch_size
+    self._updates = []
+    self._num_pruned = 0
+    self._num_removed = 0  # trie nodes
+
+  def prune(self, build):
+    # Returns the build's pruned ItemTrie, the write back is queued if it's smaller
+    trie = ItemTrie.from_document(build["itemEvents"]["neighbors"])
+    pruned = trie.pruned(self._max_depth, self._min_count)
+    if len(pruned) < len(trie):
+      self._updates.append(UpdateOne(
+        {"_id": build["_id"], "stats.count": build["stats"]["count"]},
+        {"$set": {"itemEvents.neighbors": pruned.to_document()}}
+      ))
+      self._num_pruned += 1
+      self._num_removed += len(trie) - len(pruned)
+      if len(self._updates) >= self._batch_size:
+        self.flush()
+    return pruned
+
+  @Metrics.timed("mongo.trie_pruner.flush")
+  def flush(self):
+    if self._updates:
+      self._builds.bulk_write(self._updates, ordered=False)
+      self._updates = []
+
+  def get_stats(self):
+    return {"builds": self._num_pruned, "nodes": self._num_removed}
+
+  def run(self, query=None):
+    # Prunes every build matching query, returns get_stats()
+    cursor = self._builds.find(query or {}, ["itemEvents", "stats.count"], no_cursor_timeout=True)
+    try:
+      for build in cursor:
+        self.prune(build)
+    finally:
+      cursor.close()
+    self.flush()
+    return self.get_stats()
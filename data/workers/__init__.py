@@ -1,2 +1,4 @@
 from .player_worker import PlayerWorker
-from .match_worker import MatchWorker
\ No newline at end of file
+from .match_worker import MatchWorker
+from .pipeline import CollectionPipeline
+from .checkpoint import CollectionCheckpoint
@@ -0,0 +1,95 @@
+import os
+import threading
+from bson import json_util
+
+class CollectionCheckpoint(object):
+  # Periodically saves the contents of the player and match queues, and the ids of the workers
+  # holding leases on db items, to a local file. restore() warm-starts the queues from it and
+  # hands back the leases of the previous run right away instead of waiting for them to expire.
+  INTERVAL = 60  # seconds
+
+  def __init__(self, path, **kwargs):
+    self._path = path
+    self._player_db = kwargs.pop("player_db")
+    self._match_db = kwargs.pop("match_db")
+    self._player_queue = kwargs.pop("player_queue")
+    self._match_queue = kwargs.pop("match_queue")
+    self._last_update = kwargs.pop("last_update")
+    self._interval = kwargs.pop("interval", CollectionCheckpoint.INTERVAL)
+
+    self._owners = []
+    self._is_running = False
+    self._stop_event = threading.Event()
+    self._thread = threading.Thread(target=self._run, name="CHECKPOINT")
+
+  def add_owner(self, worker_id):
+    self._owners.append(worker_id)
+
+  def _snapshot(self, queue):
+    with queue.mutex:
+      return list(queue.queue)
+
+  def save(self):
+    checkpoint = {
+      "owners": self._owners,
+      "players": self._snapshot(self._player_queue),
+      "match_refs": self._snapshot(self._match_queue),
+    }
+    directory = os.path.dirname(self._path)
+    if directory and not os.path.exists(directory):
+      os.makedirs(directory)
+    tmp_path = self._path + ".tmp"
+    with open(tmp_path, "w") as f:
+      f.write(json_util.dumps(checkpoint))
+    os.rename(tmp_path, self._path)
+
+  def _requeue(self, queue, items):
+    count = 0
+    for item in items:
+      if queue.full():
+        break  # the rest is still in the db
+      queue.put(item, False)
+      count += 1
+    return count
+
+  def restore(self):
+    # Call before starting the workers
+    if not os.path.exists(self._path):
+      return
+    try:
+      with open(self._path) as f:
+        checkpoint = json_util.loads(f.read())
+    except (IOError, ValueError) as e:
+      print "!! [CHECKPOINT] Couldn't read %s (%r)" % (self._path, e)
+      return
+
+    released = self._match_db.release_leases(checkpoint["owners"])
+    released += self._player_db.release_leases(checkpoint["owners"])
+
+    # Items may have been handled after the checkpoint was taken, only requeue what's still pending
+    match_refs = self._match_db.find_pending_refs([r["matchId"] for r in checkpoint["match_refs"]])
+    players = self._player_db.find_stale_players(
+      [p["summonerId"] for p in checkpoint["players"]], self._last_update)
+    num_match_refs = self._requeue(self._match_queue, match_refs)
+    num_players = self._requeue(self._player_queue, players)
+    print "[CHECKPOINT] Restored %d players and %d matches, released %d leases" % (
+      num_players, num_match_refs, released)
+
+  def _run(self):
+    while self._is_running:
+      self._stop_event.wait(self._interval)
+      try:
+        self.save()
+      except Exception as e:
+        print "!! [CHECKPOINT] Exception while saving: %r" % e
+
+  def start(self):
+    self._is_running = True
+    self._thread.start()
+
+  def stop(self):
+    # Call after the workers stopped, so the saved queues are final
+    self._is_running = False
+    self._stop_event.set()
+    self._thread.join()
+    self.save()
@@ -1,6 +1,8 @@
 import functools
 from .worker import Worker 
 from riot_api import RiotApi, ApiRequest
+from util import process_match
+from metrics import Metrics
 from Queue import Full, Empty
 
 class MatchWorker(Worker):
@@ -16,10 +18,27 @@ class MatchWorker(Worker):
     self._player_queue = kwargs.pop("player_queue") # Player
     self._match_queue = kwargs.pop("match_queue")  # MatchReference
     self._match_processor = kwargs.pop("match_processor")
+    self._match_pool = kwargs.pop("match_pool", None)  # MatchProcessorPool, process inline if None
+    self._claimed = []  # refs claimed from the db, not processed yet
 
   def _generate_request(self, match_ref):
-    get = functools.partial(RiotApi.get_match, match_ref["matchId"])
-    return ApiRequest(get)
+    # With a match pool, the raw json is passed on and only parsed in the pool's processes
+    if self._match_pool is not None:
+      get_cached, get = RiotApi.get_cached_match_raw, RiotApi.get_match_raw
+    else:
+      get_cached, get = RiotApi.get_cached_match, RiotApi.get_match
+
+    # Cached matches don't need to go through the scheduler and use up the rate limit
+    match = get_cached(match_ref["matchId"])
+    if match is not None:
+      Metrics.incr("match.cache_hits")
+      request = ApiRequest(lambda: match, ApiRequest.MATCH)
+      request.execute()
+      return request
+
+    # Oldest matches first, they are the closest to no longer being available from the API
+    priority = -match_ref.get("timestamp", 0)
+    return ApiRequest(functools.partial(get, match_ref["matchId"]), ApiRequest.MATCH, priority)
 
   def _player_is_good(self, league):
     return (league in ["CHALLENGER", "MASTER", "DIAMOND", "PLATINUM", "GOLD"])
@@ -39,82 +58,60 @@ class MatchWorker(Worker):
       except Full:
         return
 
-  def _get_next_match(self):
-    match = None
+  def _claim_next_match(self):
+    if not self._claimed:
+      self._claimed = self._match_db.claim_refs(self._worker_id, Worker._CLAIM_SIZE)
+    return self._claimed.pop(0) if self._claimed else None
+
+  def _next_item(self, timeout):
     try:
       # TODO add option to update old
-      match = self._match_queue.get(True, Worker._QUEUE_TIMEOUT) or self._match_db.find_needs_update()
-      return match
+      return self._match_queue.get(True, timeout)
     except Empty:
-      return self._match_db.find_needs_update()
+      return self._claim_next_match()
 
-  def _process_and_insert_build(self, participant):
+  def _process_build(self, participant):
     build = participant["build"]
 
     build["runes"] = self._build_db.insert_runes(build["runes"])
     build["masteries"] = self._build_db.insert_masteries(build["masteries"])
     build["skillups"] = self._build_db.insert_skillups(build["skillups"])
 
-    return self._build_db.insert_build(participant)
-
-  def _make_request(self, request):
-    # Try to queue api request
-    while self._is_running:
-      try:
-        self._api_scheduler.add_request(request, Worker._SCHEDULER_TIMEOUT)
-        break
-      except Full:
-        continue
-
-    # Wait for response
-    while self._is_running:
-      if request.wait(Worker._API_REQUEST_TIMEOUT):
-        break
-
-  def _perform_work(self):
-    # Get next match from queue and generate request    
-    match_ref = self._get_next_match()
-    if match_ref is None: return
-    request = self._generate_request(match_ref)
-
-    self._make_request(request)
-
-    match = request.get_data()
-    if match is None:
+  def _handle_response(self, match_ref, request):
+    data = request.get_data()
+    if data is None:
+      Metrics.incr("match.failed")
       self._match_db.return_match(match_ref)
-      print "!! [MATCH_WORKER] Failed to get match, reseting 'is_ref' for %r" % match_ref["matchId"]
+      print "!! [MATCH_WORKER] Failed to get match, returning %r to DB" % match_ref["matchId"]
       return
-    
-    # Insert players
-    players = [p["player"] for p in match["participantIdentities"]]
-    leagues = [p["highestAchievedSeasonTier"] for p in match["participants"]]
-    self._queue_players(players, leagues)
 
     # Process and insert match
     try:
-      # trimmed = self._match_processor.trim_match(match)
-      participants = self._match_processor.get_builds_from_match(match)
-      
+      with Metrics.timer("match.process"):
+        if self._match_pool is not None:
+          record = self._match_pool.process(data).result()
+        else:
+          record = process_match(self._match_processor, data)
+
+      # Insert players
+      self._queue_players(record["players"], record["leagues"])
+
       # Consolidate build, runes, masteries, etc into separate db's
-      for p in participants:
-        if len(p["build"]["finalBuild"]) < 2:
-          continue
-          
-        build_id = self._process_and_insert_build(p)
-        p["build"] = build_id
-
-      # trimmed["participants"] = participants
-      self._match_db.mark(match)
-      print "[MATCH_WORKER] Inserted match %r" % match["matchId"]
+      for p in record["participants"]:
+        self._process_build(p)
+      self._build_db.insert_builds(record["participants"])
+
+      self._match_db.mark(record["match"])
+      Metrics.incr("match.inserted")
+      print "[MATCH_WORKER] Inserted match %r" % match_ref["matchId"]
     except Exception as e:
-      print "!! Exception occurred for match: %d (%r)" % (match["matchId"], e)
+      print "!! Exception occurred for match: %d (%r)" % (match_ref["matchId"], e)
+      Metrics.incr("match.failed")
       import traceback
       traceback.print_exc()
       return
 
-
-
-
-
-
-
+  def _release_claimed(self):
+    for match_ref in self._claimed:
+      self._match_db.return_match(match_ref)
+    self._claimed = []
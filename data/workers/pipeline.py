@@ -0,0 +1,94 @@
+import threading
+from Queue import Queue, Full, Empty
+
+from .worker import Worker
+
+class CollectionPipeline(object):
+  # Alternative to running PlayerWorker/MatchWorker threads. The workers (not started) only
+  # define the stages: one FEEDER thread takes their items and submits the requests, results
+  # come back through request callbacks and are handled by a few HANDLER threads. No thread waits
+  # on a response, so the # of requests in flight isn't tied to the # of threads.
+  MAX_IN_FLIGHT = 50
+  HANDLER_THREADS = 2
+  _RESULT_QSIZE = 100
+
+  def __init__(self, **kwargs):
+    self._api_scheduler = kwargs.pop("api_scheduler")
+    self._stages = kwargs.pop("stages")  # workers, earlier ones get their items submitted first
+    self._max_in_flight = kwargs.pop("max_in_flight", CollectionPipeline.MAX_IN_FLIGHT)
+    num_handlers = kwargs.pop("handler_threads", CollectionPipeline.HANDLER_THREADS)
+
+    self._in_flight = threading.Semaphore(self._max_in_flight)
+    self._results = Queue(maxsize=CollectionPipeline._RESULT_QSIZE)  # (stage, item, request)
+    self._has_work = threading.Event()  # set when handling a result may have produced new items
+    self._is_running = False
+    self._feeder = threading.Thread(target=self._feed, name="FEEDER")
+    self._handlers = [threading.Thread(target=self._handle, name="HANDLER")
+      for i in xrange(num_handlers)]
+
+  def _submit(self, stage, item, request):
+    # Returns False if stopped before the scheduler took the request
+    request.add_done_callback(lambda request: self._results.put((stage, item, request)))
+    if request.is_done():
+      return True
+    while self._is_running:
+      try:
+        self._api_scheduler.add_request(request, Worker._SCHEDULER_TIMEOUT)
+        return True
+      except Full:
+        continue
+    request.mark_invalid()  # so the stage returns the item
+    return False
+
+  def _feed(self):
+    while self._is_running:
+      submitted = False
+      for stage in self._stages:
+        if not self._in_flight.acquire(False):
+          break
+        item = stage._next_item(0)
+        if item is None:
+          self._in_flight.release()
+          continue
+        submitted = self._submit(stage, item, stage._generate_request(item)) or submitted
+
+      if not submitted:
+        # Nothing to do (or too much in flight) until a result comes back
+        self._has_work.wait(Worker._QUEUE_TIMEOUT)
+        self._has_work.clear()
+
+  def _handle(self):
+    while self._is_running or not self._results.empty():
+      try:
+        stage, item, request = self._results.get(True, Worker._QUEUE_TIMEOUT)
+      except Empty:
+        continue
+      try:
+        stage._handle_response(item, request)
+      except Exception as e:
+        print "!! [PIPELINE] Exception while handling %r (%r)" % (item, e)
+      finally:
+        self._in_flight.release()
+        self._has_work.set()
+
+  def get_ids(self):
+    return [worker_id for stage in self._stages for worker_id in stage.get_ids()]
+
+  def is_alive(self):
+    return self._feeder.is_alive() and all(handler.is_alive() for handler in self._handlers)
+
+  def start(self):
+    self._is_running = True
+    for handler in self._handlers:
+      handler.start()
+    self._feeder.start()
+
+  def stop(self):
+    # Call after stopping the scheduler, which fails any requests still queued there
+    self._is_running = False
+    self._has_work.set()
+    self._feeder.join()
+    for handler in self._handlers:
+      handler.join()
+    for stage in self._stages:
+      stage._release_claimed()
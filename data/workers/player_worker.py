@@ -1,7 +1,8 @@
 import functools
 from .worker import Worker 
 from riot_api import RiotApi, ApiRequest
-from Queue import Full, Empty
+from metrics import Metrics
+from Queue import Empty, Full
 
 class PlayerWorker(Worker):
 
@@ -17,6 +18,7 @@ class PlayerWorker(Worker):
     self._last_update = kwargs.pop("last_update")
     self._player_queue = kwargs.pop("player_queue") # Player
     self._match_queue = kwargs.pop("match_queue")  # MatchReference
+    self._claimed = []  # stale players claimed from the db, not updated yet
 
   def _generate_request(self, player):
     get = functools.partial(RiotApi.get_matches, player["summonerId"], {
@@ -24,55 +26,45 @@ class PlayerWorker(Worker):
         "beginTime": player["last_update"]
     })
 
-    return ApiRequest(get)
+    # Stalest players first, they have the most new matches
+    return ApiRequest(get, ApiRequest.MATCHLIST, priority=-player["last_update"])
 
-  def _get_player_from_queue(self):
+  def _get_player_from_queue(self, timeout):
     try:
-      player = self._player_queue.get(True, Worker._QUEUE_TIMEOUT)
+      player = self._player_queue.get(True, timeout)
       return player
     except Empty:
       return None
 
-  def _get_next_player(self):
+  def _claim_stale_player(self):
+    if not self._claimed:
+      self._claimed = self._player_db.claim_stale(self._last_update, self._worker_id, Worker._CLAIM_SIZE)
+    return self._claimed.pop(0) if self._claimed else None
+
+  def _next_item(self, timeout):
     player = None
     if self._is_prioritize_new:
-      player = self._get_player_from_queue() or self._player_db.find_stale(self._last_update)
+      player = self._get_player_from_queue(timeout) or self._claim_stale_player()
     else:
-      player = self._player_db.find_stale(self._last_update) or self._get_player_from_queue()
+      player = self._claim_stale_player() or self._get_player_from_queue(timeout)
     return player
 
   def _queue_matches(self, matches):
-    for match_ref in matches:
-      if "NA" not in match_ref["platformId"]:
-        continue
-      if not self._match_db.contains(match_ref):
-        self._match_db.insert_ref(match_ref)
-        # TODO doing duplicate work?
-        self._match_queue.put(match_ref)
-
-  def _perform_work(self):
-    # Generate request
-    player = self._get_next_player()
-    if player is None: return
-    request = self._generate_request(player)
-    
-    # Try to queue api request
-    while self._is_running:
+    match_refs = [match_ref for match_ref in matches if "NA" in match_ref["platformId"]]
+    new_refs = self._match_db.insert_refs(match_refs)
+    Metrics.incr("player.new_matches", len(new_refs))
+    for match_ref in new_refs:
       try:
-        self._api_scheduler.add_request(request, Worker._SCHEDULER_TIMEOUT)
-        break
+        self._match_queue.put(match_ref, False)
       except Full:
-        continue
-
-    # Wait for response
-    while self._is_running:
-      if request.wait(Worker._API_REQUEST_TIMEOUT):
-        break
+        return  # the rest is still in the db, where match workers claim it from
 
+  def _handle_response(self, player, request):
     data = request.get_data()
     if data is None:
       # TODO, reset player if request didnt finish
       print "!! [PLAYER_WORKER] Failed to get player: %s, returning to DB" % player["summonerName"]
+      Metrics.incr("player.failed")
       self._player_db.return_player(player)
       return
 
@@ -80,12 +72,11 @@ class PlayerWorker(Worker):
     print ("[PLAYER_WORKER] Updated player '%s' (%s) with time %r (last update was %r)" %
       (player["summonerName"], player["league"], request.get_timestamp(), player["last_update"]))
     self._player_db.update_matches(player, request.get_timestamp())
+    Metrics.incr("player.updated")
     if data["totalGames"] > 0:
       self._queue_matches(data["matches"])
 
-
-
-
-
-
-
+  def _release_claimed(self):
+    for player in self._claimed:
+      self._player_db.return_player(player)
+    self._claimed = []
@@ -1,27 +1,77 @@
+import itertools
+import os
+import socket
 import threading
+from Queue import Full
 
 class Worker(object):
   _SCHEDULER_TIMEOUT = .3  # seconds
   _API_REQUEST_TIMEOUT = .3  # seconds
   _QUEUE_TIMEOUT = .3  # seconds
+  _CLAIM_SIZE = 10  # items claimed from the db at once
+  _ids = itertools.count()
 
   def __init__(self, **kwargs):
     self._name = kwargs.pop("name", "WORKER")
+    # Owner of the db items this worker claims, unique across processes and hosts
+    self._worker_id = "%s:%d:%s-%d" % (socket.gethostname(), os.getpid(), self._name, next(Worker._ids))
     self._is_running = False
     self._thread = threading.Thread(target=self._run, name=self._name)
 
-  def _perform_work(self):
-    # Override this
+  def get_ids(self):
+    # Owner ids this worker claims db items with
+    return [self._worker_id]
+
+  def _next_item(self, timeout):
+    # Override this, returns the next item to request data for or None if there is none
+    return None
+
+  def _generate_request(self, item):
+    # Override this, returns an ApiRequest (already done if the data didn't need the API)
+    pass
+
+  def _handle_response(self, item, request):
+    # Override this, request.get_data() is None if the request failed
+    pass
+
+  def _release_claimed(self):
+    # Override this, returns items claimed from the db but not handled yet
     pass
 
+  def _make_request(self, request):
+    # Try to queue api request
+    while self._is_running:
+      try:
+        self._api_scheduler.add_request(request, Worker._SCHEDULER_TIMEOUT)
+        break
+      except Full:
+        continue
+
+    # Wait for response
+    while self._is_running:
+      if request.wait(Worker._API_REQUEST_TIMEOUT):
+        break
+
+  def _perform_work(self):
+    item = self._next_item(Worker._QUEUE_TIMEOUT)
+    if item is None: return
+    request = self._generate_request(item)
+    if not request.is_done():
+      self._make_request(request)
+    self._handle_response(item, request)
+
   def _run(self):
     while self._is_running:
       self._perform_work()
 
+  def is_alive(self):
+    return self._thread.is_alive()
+
   def start(self):
     self._is_running = True
     self._thread.start()
 
   def stop(self):
     self._is_running = False
-    self._thread.join()
\ No newline at end of file
+    self._thread.join()
+    self._release_claimed()
\ No newline at end of file